@@ -0,0 +1,836 @@
+# benchmark.py
+# Timing scripts for the helper functions in functions2
+# Usage: python benchmark.py tax --sizes 10000 1000000 10000000
+#        python benchmark.py update --rows 10000 100000 --updates 200
+#        python benchmark.py recalc --rows 1000000 --workers 1 2 4 8
+#        python benchmark.py rules --rows 1000000
+#        python benchmark.py stress --processes 4 --threads 8 --writes 100
+#        python benchmark.py service --connections 32 --seconds 10
+#        python benchmark.py memory --rows 100000 1000000
+#        python benchmark.py startup --runs 10 --rows 1000000
+#        python benchmark.py logins --iterations 10000 100000 600000
+#        python benchmark.py suite --rows 1000 10000 100000 1000000 10000000 --output results.json
+#        python benchmark.py suite --rows 100000 --profile --baseline results.json
+#        python benchmark.py metrics --rows 100000 --calls 20000
+#        python benchmark.py whatif --scenarios 1000 10000 100000
+#        python benchmark.py changes --rows 100000 1000000 --changes 100 1000 10000
+
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from functions2 import (CHANGE_SEQ, RECORD_COLUMNS, calculate_tax, calculate_tax_batch, check_user_exists,
+                        compact_records, format_csv_rows, get_user_record, iter_records, read_from_csv,
+                        save_many_to_csv, save_to_csv)
+from record_index import invalidate_index
+from tax_rules import DEFAULT_YEAR, get_tax_rules
+
+
+# Random incomes and relief totals shaped like tax_records.csv
+def make_payers(n, seed=0):
+    rng = np.random.default_rng(seed)
+    income = rng.uniform(0, 600000, n).round(2)
+    relief = rng.uniform(9000, 60000, n).round(2)
+    return income, relief
+
+
+# Synthetic ledger with the record columns (RECORD_COLUMNS) and change_seq; IDs are user_<start> onwards
+def make_ledger(n, seed=0, start=0):
+    rng = np.random.default_rng(seed)
+    income, _ = make_payers(n, seed)
+    children = rng.integers(0, 4, n)
+    df = pd.DataFrame({
+        'id': [f'user_{i}' for i in range(start, start + n)],
+        'ic_number': [f'{ic:012d}' for ic in rng.integers(0, 10**12, n)],
+        'income': income,
+        'individual_relief': 9000.0,
+        'spouse_relief': rng.choice([0.0, 4000.0], n),
+        'child_relief': children * 8000.0,
+        'num_children': children,
+        'medical_relief': rng.uniform(0, 8000, n).round(2),
+        'lifestyle_relief': rng.uniform(0, 2500, n).round(2),
+        'education_relief': rng.choice([0.0, 7000.0], n),
+        'parental_relief': rng.uniform(0, 5000, n).round(2)})
+    df['total_relief'] = sum(df[column] for column in get_tax_rules().relief_columns)
+    df['chargeable_income'], df['tax_payable'] = calculate_tax_batch(df['income'], df['total_relief'])
+    df[CHANGE_SEQ] = range(start + 1, start + n + 1)
+    return df
+
+
+# Time a function call and return (seconds, result)
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+# Current way: one calculate_tax call per payer
+def tax_per_row(income, relief):
+    return [calculate_tax(i, r) for i, r in zip(income.tolist(), relief.tolist())]
+
+
+# Compare the per-row loop with calculate_tax_batch and check they agree
+def bench_tax(sizes, loop_limit):
+    print(f"{'rows':>12} {'loop (s)':>10} {'batch (s)':>10} {'speedup':>9}")
+    for n in sizes:
+        income, relief = make_payers(n)
+        batch_time, (_, batch_tax) = timed(calculate_tax_batch, income, relief)
+
+        if n <= loop_limit:
+            loop_time, loop_tax = timed(tax_per_row, income, relief)
+            if not np.array_equal(np.array(loop_tax), batch_tax):
+                print(f"  mismatch at {n} rows!")
+        else:
+            # Time a slice of the loop and scale it up
+            part = loop_limit
+            loop_time, _ = timed(tax_per_row, income[:part], relief[:part])
+            loop_time *= n / part
+        print(f"{n:>12,} {loop_time:>10.3f} {batch_time:>10.3f} {loop_time / batch_time:>8.0f}x")
+
+
+# The old update path: read the whole file, drop the user's row, rewrite everything
+def rewrite_update(data, filename):
+    existing_df = pd.read_csv(filename, dtype={'ic_number': str})
+    existing_df = existing_df[existing_df['id'] != data['id']]
+    combined_df = pd.concat([existing_df, pd.DataFrame([data])], ignore_index=True)
+    combined_df.to_csv(filename, index=False)
+
+
+# Updates per second of the old rewrite path vs the appended versions in save_to_csv
+def bench_update(sizes, updates):
+    print(f"{'rows':>10} {'rewrite/s':>10} {'append/s':>10} {'compact (s)':>12}")
+    with tempfile.TemporaryDirectory() as folder:
+        for n in sizes:
+            ledger = make_ledger(n)
+            changed = ledger.sample(updates, random_state=1).to_dict('records')
+            for record in changed:
+                record['income'] += 1000
+
+            filename = os.path.join(folder, f'ledger_{n}.csv')
+            ledger.to_csv(filename, index=False)
+            start = time.perf_counter()
+            for record in changed:
+                rewrite_update(record, filename)
+            rewrite_rate = updates / (time.perf_counter() - start)
+
+            ledger.to_csv(filename, index=False)
+            start = time.perf_counter()
+            # save_to_csv prints a line per update; keep the terminal out of the timing
+            with contextlib.redirect_stdout(io.StringIO()):
+                for record in changed:
+                    save_to_csv(dict(record), filename, update_existing=True)
+            append_rate = updates / (time.perf_counter() - start)
+            compact_time, _ = timed(compact_records, filename)
+            print(f"{n:>10,} {rewrite_rate:>10.1f} {append_rate:>10.1f} {compact_time:>12.3f}")
+
+
+# Throughput of recalculate_records with 1 to N worker processes
+def bench_recalc(rows, worker_counts, chunk_rows):
+    from recalculate import recalculate_records
+    print(f"{'workers':>8} {'seconds':>9} {'records/s':>12} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'ledger.csv')
+        make_ledger(rows).to_csv(filename, index=False)
+        baseline = None
+        for workers in worker_counts:
+            done, seconds = recalculate_records(filename, workers, chunk_rows, progress=False)
+            baseline = baseline or seconds
+            print(f"{workers:>8} {seconds:>9.2f} {done / seconds:>12,.0f} {baseline / seconds:>7.1f}x")
+
+
+# The 2024 if-chain calculate_tax used before the brackets moved to tax_rules.json
+def calculate_tax_chain(income, tax_relief):
+    chargeable_income = income - tax_relief
+    if chargeable_income <= 5000:
+        return 0.0
+    tax_payable = 0.0
+    for lower, upper, rate in [(5000, 20000, 0.01), (20000, 35000, 0.03), (35000, 50000, 0.06),
+                               (50000, 70000, 0.11), (70000, 100000, 0.19), (100000, 400000, 0.25),
+                               (400000, 600000, 0.26), (600000, 2000000, 0.28)]:
+        if chargeable_income > lower:
+            tax_payable += (min(chargeable_income, upper) - lower) * rate
+    if chargeable_income > 2000000:
+        tax_payable += (chargeable_income - 2000000) * 0.30
+    return round(tax_payable, 2)
+
+
+# The year-rules lookup in calculate_tax vs walking the old bracket chain
+def bench_rules(rows):
+    income, relief = make_payers(rows)
+    income, relief = income.tolist(), relief.tolist()
+    chain_time, chain_tax = timed(lambda: [calculate_tax_chain(i, r) for i, r in zip(income, relief)])
+    lookup_time, lookup_tax = timed(lambda: [calculate_tax(i, r) for i, r in zip(income, relief)])
+    print(f"{'':>8} {'seconds':>9} {'ns/call':>9}")
+    print(f"{'chain':>8} {chain_time:>9.3f} {chain_time / rows * 1e9:>9.0f}")
+    print(f"{'lookup':>8} {lookup_time:>9.3f} {lookup_time / rows * 1e9:>9.0f}")
+    print(f"identical results: {chain_tax == lookup_tax}")
+
+
+# One stress-test process: `threads` threads each register `writes` users, then update them all
+def _stress_worker(filename, process, threads, writes):
+    template = make_ledger(1).iloc[0].to_dict()
+    failures = []
+
+    def session(thread):
+        for i in range(writes):
+            record = dict(template, id=f'p{process}_t{thread}_{i}', income=float(i))
+            if not save_to_csv(record, filename):
+                failures.append(record['id'])
+        for i in range(writes):
+            record = dict(template, id=f'p{process}_t{thread}_{i}', income=float(i) + 0.5)
+            if not save_to_csv(record, filename, update_existing=True):
+                failures.append(record['id'])
+
+    sessions = [threading.Thread(target=session, args=(t,)) for t in range(threads)]
+    for thread in sessions:
+        thread.start()
+    for thread in sessions:
+        thread.join()
+    return failures
+
+
+# User IDs pandas would read as missing values unless told not to
+NA_LIKE_IDS = ['NA', 'null', 'None', 'nan', 'N/A']
+
+
+# Registers and updates users with NA-like IDs, then reads them back every way the records are
+# read (the old rows stay in the file, so iter_records and TaxLedger.load have to skip them)
+def check_na_like_ids(folder):
+    from record_model import TaxLedger
+    filename = os.path.join(folder, 'na_ids.csv')
+    template = make_ledger(1).iloc[0].to_dict()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for income in (0.0, 0.5):
+            for user_id in NA_LIKE_IDS:
+                save_to_csv(dict(template, id=user_id, income=income), filename, update_existing=bool(income))
+    expected = sorted(NA_LIKE_IDS)
+    reads = {
+        'read_from_csv': sorted(read_from_csv(filename)['id']),
+        'iter_records': sorted(user_id for chunk in iter_records(filename) for user_id in chunk['id']),
+        'TaxLedger.load': sorted(user_id.decode() for user_id in TaxLedger.load(filename).ids),
+        'get_user_record': sorted(get_user_record(user_id, filename)['id'] for user_id in NA_LIKE_IDS),
+    }
+    wrong = [name for name, ids in reads.items() if ids != expected]
+    print(f"NA-like user IDs: {len(NA_LIKE_IDS)} users, read back wrong by: {', '.join(wrong) or 'none'}")
+    return not wrong
+
+
+# Many processes x threads writing to the same file at once; checks that no row is lost or torn
+def bench_stress(processes, threads, writes):
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'ledger.csv')
+        make_ledger(1).iloc[:0].to_csv(filename, index=False)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), ProcessPoolExecutor(processes) as pool:
+            results = [pool.submit(_stress_worker, filename, p, threads, writes) for p in range(processes)]
+            failures = [record_id for result in results for record_id in result.result()]
+        elapsed = time.perf_counter() - start
+
+        total = processes * threads * writes
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        torn = [line for line in lines if line.count(',') != lines[0].count(',')]
+        records = read_from_csv(filename)
+        expected = {f'p{p}_t{t}_{i}' for p in range(processes) for t in range(threads) for i in range(writes)}
+        missing = expected - set(records['id'])
+        stale = int((records['income'] % 1 != 0.5).sum())
+        # every row written must have its own change_seq, in the order the rows are in the file
+        sequence = pd.read_csv(filename, usecols=[CHANGE_SEQ])[CHANGE_SEQ].diff().dropna()
+        out_of_order = int((sequence <= 0).sum())
+
+        print(f"{processes} processes x {threads} threads: {2 * total:,} writes in {elapsed:.2f}s "
+              f"({2 * total / elapsed:,.0f} writes/s)")
+        # old versions may have been compacted away, but every user must be there with their update
+        print(f"users: {len(records):,} (expected {total:,}), rows in file: {len(lines) - 1:,}, "
+              f"torn lines: {len(torn)}, missing users: {len(missing)}, lost updates: {stale}, "
+              f"failed saves: {len(failures)}, change_seq out of order: {out_of_order}")
+        ok = len(records) == total and not torn and not missing and not stale and not failures and not out_of_order
+        ok = check_na_like_ids(folder) and ok
+        print("PASS" if ok else "FAIL")
+        return ok
+
+
+# One keep-alive client connection sending requests in a loop until the deadline.
+# Tokens from /login responses go into `tokens` (user ID -> token) for the record lookups.
+async def _load_client(host, port, requests, deadline, latencies, errors, tokens):
+    import asyncio
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        i = 0
+        while time.perf_counter() < deadline:
+            method, path, body, user_id = requests[i % len(requests)]
+            i += 1
+            payload = json.dumps(body).encode() if body is not None else b''
+            auth = f"Authorization: Bearer {tokens[user_id]}\r\n" if user_id in tokens else ''
+            start = time.perf_counter()
+            writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n{auth}"
+                         f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            response = await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if path == '/login' and status == 200:
+                tokens[user_id] = json.loads(response)['token']
+            if status >= 500:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+# Load test the HTTP service: record lookups, logins and quotes from many connections.
+# Starts a local tax_service.py on a temporary ledger unless --port points at a running one.
+def bench_service(connections, seconds, rows, port=None, host='127.0.0.1'):
+    import asyncio
+
+    with tempfile.TemporaryDirectory() as folder:
+        server = None
+        if port is None:
+            filename = os.path.join(folder, 'ledger.csv')
+            ledger = make_ledger(rows)
+            ledger.to_csv(filename, index=False)
+            port = 8765
+            # cheap password hashes, so the first login of each user doesn't swamp the test
+            # (benchmark.py logins measures the hashing cost)
+            server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tax_service.py'),
+                                       '--port', str(port), '--records', filename],
+                                      stdout=subprocess.PIPE, text=True,
+                                      env=dict(os.environ, TAX_PASSWORD_ITERATIONS='1000'))
+            server.stdout.readline()   # wait for "listening"
+            users = ledger.sample(min(rows, 1000), random_state=0)
+            users = [{'id': user_id, 'password': ic_number[-4:]} for user_id, ic_number in zip(users['id'], users['ic_number'])]
+        else:
+            users = [{'id': 'Ali_Ahmad', 'password': '5522'}]
+
+        requests = []
+        for k, user in enumerate(users):
+            requests.append(('POST', '/login', {'id': user['id'], 'password': str(user['password'])}, user['id']))
+            requests.append(('GET', f"/records/{quote(user['id'])}", None, user['id']))
+            requests.append(('POST', '/quote', {'income': 40000 + 100 * (k % 500), 'individual_relief': 9000,
+                                                'num_children': k % 3}, None))
+        latencies, errors, tokens = [], [], {}
+        try:
+            async def run():
+                deadline = time.perf_counter() + seconds
+                await asyncio.gather(*[_load_client(host, port, requests[c:] + requests[:c], deadline,
+                                                    latencies, errors, tokens)
+                                       for c in range(connections)])
+            start = time.perf_counter()
+            asyncio.run(run())
+            elapsed = time.perf_counter() - start
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    latencies = np.array(latencies) * 1000
+    print(f"{len(latencies):,} requests from {connections} connections in {elapsed:.1f}s: "
+          f"{len(latencies) / elapsed:,.0f} requests/s")
+    print(f"latency p50 {np.percentile(latencies, 50):.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms, "
+          f"max {latencies.max():.2f} ms, server errors: {len(errors)}")
+
+
+# Bytes held by a list of record dicts (measured with tracemalloc)
+def dict_records_bytes(df):
+    tracemalloc.start()
+    records = df.to_dict('records')
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size
+
+
+# True if the ledger holds the same values as the DataFrame
+def same_records(ledger, df):
+    for name in RECORD_COLUMNS:
+        ours, theirs = ledger.column(name), df[name].to_numpy()
+        if ours.dtype.kind == 'U':
+            theirs = theirs.astype(str)
+        if not np.array_equal(ours, theirs):
+            return False
+    return True
+
+
+# Memory per payer: the DataFrame read_from_csv returns (as loaded, and with the strings as
+# Python objects like older pandas), the ledger as record dicts (what get_user_record hands
+# out) and the compact TaxLedger
+def bench_memory(sizes):
+    from record_model import TaxLedger
+    print("bytes per record")
+    print(f"{'rows':>10} {'DataFrame':>10} {'object str':>11} {'dicts':>8} {'TaxLedger':>10} {'identical':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            filename = os.path.join(tmp, f'ledger_{n}.csv')
+            make_ledger(n).to_csv(filename, index=False)
+            df = read_from_csv(filename)
+            frame_bytes = df.memory_usage(deep=True).sum()
+            object_bytes = df.astype({'id': object, 'ic_number': object}).memory_usage(deep=True).sum()
+            dict_bytes = dict_records_bytes(df)
+            ledger = TaxLedger.load(filename)
+            print(f"{n:>10} {frame_bytes / n:>10.0f} {object_bytes / n:>11.0f} {dict_bytes / n:>8.0f} "
+                  f"{ledger.nbytes / n:>10.0f} {str(same_records(ledger, df)):>10}")
+            del df, ledger
+
+
+# Import time of a module in a fresh interpreter, in seconds (the cumulative figure
+# python -X importtime reports for it)
+def import_seconds(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    return float('nan')
+
+
+# Seconds from starting main2.py until the menu prompt is printed
+def time_to_menu(filename):
+    env = dict(os.environ, TAX_RECORDS_FILE=filename)
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main2.py'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    output = b''
+    while b'Enter your choice' not in output:
+        data = process.stdout.read1(4096)
+        if not data:
+            break
+        output += data
+    elapsed = time.perf_counter() - start
+    process.communicate(b'4\n')
+    return elapsed
+
+
+# Seconds a fresh process takes for its first check_user_exists
+def first_lookup_seconds(filename, user_id):
+    code = ("import time; start = time.perf_counter(); from functions2 import check_user_exists; "
+            f"check_user_exists({user_id!r}, {filename!r}); print(time.perf_counter() - start)")
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.split()[-1])
+
+
+# Startup cost: import times, time to the menu, and the first user lookup with and without
+# the saved index snapshot (medians over `runs` fresh processes)
+def bench_startup(runs, rows):
+    median = lambda func, *args: float(np.median([func(*args) for _ in range(runs)]))
+    print(f"import pandas:  {median(import_seconds, 'pandas') * 1000:8.1f} ms")
+    print(f"import main2:   {median(import_seconds, 'main2') * 1000:8.1f} ms")
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'tax_records.csv')
+        make_ledger(rows).to_csv(filename, index=False)
+        print(f"time to menu:   {median(time_to_menu, filename) * 1000:8.1f} ms")
+
+        index_file = filename + '.idx'
+        user_id = f'user_{rows - 1}'
+
+        def cold():
+            if os.path.exists(index_file):
+                os.remove(index_file)
+            return first_lookup_seconds(filename, user_id)
+        print(f"first lookup, {rows:,} rows, no index snapshot: {median(cold) * 1000:8.1f} ms")
+
+        first_lookup_seconds(filename, user_id)   # leaves a snapshot behind
+        print(f"first lookup, {rows:,} rows, index snapshot:    "
+              f"{median(first_lookup_seconds, filename, user_id) * 1000:8.1f} ms")
+
+        # rows appended by another session since the snapshot are caught up, not rescanned
+        save_many_to_csv(make_ledger(100, seed=1).assign(id=[f'new_{i}' for i in range(100)]), filename)
+        print(f"first lookup after 100 appended rows:        "
+              f"{first_lookup_seconds(filename, user_id) * 1000:8.1f} ms")
+
+
+# Logins per second for each password hash cost: a first login has to run the hash,
+# a repeat login in the same session is answered from the verified-session cache
+def bench_logins(costs, users, repeats):
+    from credentials import CredentialStore
+    passwords = {f'user_{i}': f'{i % 10000:04d}' for i in range(users)}
+    print(f"{'iterations':>10} {'hash (ms)':>10} {'first logins/s':>15} {'repeat logins/s':>16} {'wrong pw/s':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for cost in costs:
+            filename = os.path.join(tmp, f'{cost}.credentials')
+            hash_time, _ = timed(CredentialStore(filename, cost).set_passwords, passwords)
+            store = CredentialStore(filename, cost)
+            first_time, first = timed(lambda: [store.verify(u, p) for u, p in passwords.items()])
+            repeat_time, repeat = timed(lambda: [store.verify(u, p) for _ in range(repeats) for u, p in passwords.items()])
+            wrong_time, wrong = timed(lambda: [store.verify(u, 'nope') for u in passwords])
+            if not (all(first) and all(repeat) and not any(wrong)):
+                print(f"{cost:>10,} WRONG RESULT")
+            print(f"{cost:>10,} {hash_time / users * 1000:>10.1f} {users / first_time:>15,.1f} "
+                  f"{users * repeats / repeat_time:>16,.0f} {users / wrong_time:>11,.1f}")
+
+
+# Random relief scenarios for what_if, every relief between 0 and its cap
+def make_scenarios(n, year, seed=0):
+    from what_if import relief_caps
+    rng = np.random.default_rng(seed)
+    rules = get_tax_rules(year)
+    scenarios = {name: rng.integers(0, int(cap) + 1, n).astype(float)
+                 for name, cap in relief_caps(year).items() if name != 'child_relief'}
+    scenarios['num_children'] = rng.integers(0, rules.max_children + 1, n)
+    return pd.DataFrame(scenarios)
+
+
+# Scenarios per second of what_if (one batch) vs adding up the reliefs and calling
+# calculate_tax for each scenario, and a check that both give the same tax
+def bench_whatif(sizes, year):
+    from what_if import marginal_savings, what_if
+    rules = get_tax_rules(year)
+    record = make_ledger(1).iloc[0].to_dict()
+    print(f"{'scenarios':>10} {'loop (s)':>9} {'what_if (s)':>12} {'scenarios/s':>13} {'speedup':>8} {'same':>5}")
+    for n in sizes:
+        scenarios = make_scenarios(n, year)
+        rows = scenarios.to_dict('records')
+
+        def loop():
+            taxes = []
+            for row in rows:
+                row = dict(row, child_relief=row['num_children'] * rules.child_relief)
+                taxes.append(calculate_tax(record['income'], sum(row[c] for c in rules.relief_columns), year))
+            return taxes
+
+        loop_time, loop_tax = timed(loop)
+        batch_time, result = timed(what_if, record, scenarios, year)
+        same = np.array_equal(result['tax_payable'].to_numpy(), np.array(loop_tax))
+        print(f"{n:>10,} {loop_time:>9.3f} {batch_time:>12.4f} {n / batch_time:>13,.0f} "
+              f"{loop_time / batch_time:>7.0f}x {'yes' if same else 'NO':>5}")
+    marginal_time, _ = timed(marginal_savings, record, year)
+    print(f"marginal_savings: {marginal_time * 1000:.2f} ms")
+
+
+# Nightly sync cost: exporting the records changed since a checkpoint vs reading the whole
+# ledger and writing every record, after `changes` users were updated
+def bench_changes(sizes, change_counts):
+    from delta_export import _ndjson, export_changes
+    print(f"{'rows':>10} {'changes':>8} {'full (s)':>9} {'delta (s)':>10} {'speedup':>8} {'same':>5}")
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in sizes:
+            for changes in change_counts:
+                filename = os.path.join(folder, f'ledger_{rows}_{changes}.csv')
+                make_ledger(rows).to_csv(filename, index=False)
+                changed = make_ledger(changes, seed=1, start=rows // 2)
+                changed['income'] += 1000
+                save_many_to_csv(changed, filename)
+
+                def full():
+                    df = read_from_csv(filename)
+                    return len(_ndjson(df))
+
+                full_time, _ = timed(full)
+                output = io.StringIO()
+                delta_time, (written, checkpoint) = timed(export_changes, output, rows, filename)
+                exported = [json.loads(line)['id'] for line in output.getvalue().splitlines()]
+                same = exported == list(changed['id']) and checkpoint == rows + changes
+                print(f"{rows:>10,} {changes:>8,} {full_time:>9.3f} {delta_time:>10.4f} "
+                      f"{full_time / delta_time:>7.0f}x {'yes' if same else 'NO':>5}")
+                invalidate_index(filename)
+
+
+# ---- suite: timings of the functions2 hot paths on ledgers of 1k to 10M rows, as JSON ----
+
+SUITE_SIZES = [1000, 10000, 100000, 1000000]
+
+
+# Ledger file of n rows for the suite, built a million rows at a time from fixed seeds and
+# kept in data_dir, so later runs (and runs on other commits) time exactly the same data
+def suite_ledger(n, data_dir):
+    filename = os.path.join(data_dir, f'ledger_{n}.csv')
+    if not os.path.exists(filename):
+        with open(filename + '.tmp', 'w', newline='') as f:
+            f.write(','.join(RECORD_COLUMNS + [CHANGE_SEQ]) + '\n')
+            for start in range(0, n, 1000000):
+                part = make_ledger(min(1000000, n - start), seed=start, start=start)
+                f.write(format_csv_rows(part[RECORD_COLUMNS + [CHANGE_SEQ]]))
+        os.replace(filename + '.tmp', filename)
+    return filename
+
+
+# The operations timed for one ledger, in the order they run: (name, function).
+# Each function takes a run number (so repeated runs save different users) and returns
+# how many items it handled.
+def suite_operations(filename, rows, calls, seed=0):
+    from main2 import PAGE_SIZE, view_tax_records
+    rng = np.random.default_rng(seed)
+    lookup_ids = [f'user_{i}' for i in rng.integers(0, rows, calls)]
+    income, relief = make_payers(min(rows, 1000000), seed)
+    income_list, relief_list = income.tolist(), relief.tolist()
+    changed = make_ledger(calls, seed + 1)
+    changed['id'] = lookup_ids
+    changed['income'] += 1000
+
+    def tax(run):
+        for i, r in zip(income_list, relief_list):
+            calculate_tax(i, r)
+        return len(income_list)
+
+    def tax_batch(run):
+        calculate_tax_batch(income, relief)
+        return len(income)
+
+    def read(run):
+        return len(read_from_csv(filename))
+
+    def first_lookup(run):
+        # a new session: no index in memory or on disk
+        invalidate_index(filename)
+        if os.path.exists(filename + '.idx'):
+            os.remove(filename + '.idx')
+        check_user_exists(lookup_ids[0], filename)
+        return 1
+
+    def exists(run):
+        for user_id in lookup_ids:
+            check_user_exists(user_id, filename)
+        return calls
+
+    def record(run):
+        for user_id in lookup_ids:
+            get_user_record(user_id, filename)
+        return calls
+
+    def view_page(run):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for k in range(10):
+                view_tax_records(PAGE_SIZE, (rows // 10) * k, filename=filename)
+        return 10 * PAGE_SIZE
+
+    def view_all(run):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            view_tax_records(filename=filename)
+        return rows
+
+    def append(run):
+        new = make_ledger(calls, seed + 2, start=rows + (run + 1) * calls)
+        for data in new.to_dict('records'):
+            save_to_csv(data, filename)
+        return calls
+
+    def update(run):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for data in changed.to_dict('records'):
+                save_to_csv(data, filename, update_existing=True)
+        return calls
+
+    return [('calculate_tax', tax), ('calculate_tax_batch', tax_batch), ('read_from_csv', read),
+            ('check_user_exists (cold index)', first_lookup), ('check_user_exists', exists),
+            ('get_user_record', record), ('view_tax_records (pages)', view_page),
+            ('view_tax_records (all)', view_all), ('save_to_csv (append)', append),
+            ('save_to_csv (update)', update)]
+
+
+# Run func under cProfile and tracemalloc: (peak bytes allocated, hottest functions by own time)
+def profile_operation(func, top):
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        func()
+    finally:
+        profiler.disable()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    stats = pstats.Stats(profiler).stats
+    hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    return peak, [{'function': f"{os.path.basename(path)}:{line}({name})", 'calls': calls,
+                   'own_seconds': round(own, 6), 'cumulative_seconds': round(cumulative, 6)}
+                  for (path, line, name), (_, calls, own, cumulative, _) in hottest]
+
+
+# Commit, versions and machine the results came from
+def suite_environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': sys.version.split()[0], 'numpy': np.__version__,
+            'pandas': pd.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+# Time every operation on each ledger size and write the results as JSON.
+# profile=True also runs each operation again under cProfile / tracemalloc.
+def bench_suite(sizes, calls, output, data_dir=None, profile=False, top=10, baseline=None):
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = {(r['rows'], r['operation']): r for r in json.load(f)['results']}
+
+    results = []
+    print(f"{'rows':>10} {'operation':<32} {'items':>10} {'seconds':>9} {'us/item':>10}"
+          + (f" {'baseline':>9}" if baseline else '') + (f" {'peak MB':>8}" if profile else ''))
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        for n in sizes:
+            # work on a copy so the saves don't change the ledger the next run starts from
+            filename = os.path.join(tmp, f'work_{n}.csv')
+            shutil.copyfile(suite_ledger(n, data_dir), filename)
+            for name, operation in suite_operations(filename, n, calls):
+                seconds, items = timed(operation, 0)
+                result = {'rows': n, 'operation': name, 'items': items, 'seconds': round(seconds, 6),
+                          'us_per_item': round(seconds / items * 1e6, 4)}
+                line = f"{n:>10,} {name:<32} {items:>10,} {seconds:>9.3f} {result['us_per_item']:>10.2f}"
+                if baseline:
+                    before = previous.get((n, name))
+                    line += f" {result['us_per_item'] / before['us_per_item']:>8.2f}x" if before else f" {'-':>9}"
+                if profile:
+                    result['peak_bytes'], result['hot_functions'] = profile_operation(lambda: operation(1), top)
+                    line += f" {result['peak_bytes'] / 1e6:>8.1f}"
+                results.append(result)
+                print(line, flush=True)
+            invalidate_index(filename)
+
+    with open(output, 'w') as f:
+        json.dump({'environment': suite_environment(), 'calls': calls, 'results': results}, f, indent=1)
+    print(f"Results written to {output}")
+
+
+# Cost of the metrics hooks: each operation called directly (no wrapper), through its
+# wrapper with metrics off, and with metrics on
+def bench_metrics(rows, calls):
+    import metrics
+    from functions2 import count_records
+    print(f"{'operation':<22} {'raw (us)':>9} {'off (us)':>9} {'on (us)':>9} {'off cost':>9} {'on cost':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'ledger.csv')
+        make_ledger(rows).to_csv(filename, index=False)
+        user_ids = [f'user_{i}' for i in np.random.default_rng(0).integers(0, rows, calls)]
+        income, relief = make_payers(100)
+        operations = [('check_user_exists', check_user_exists, lambda func: [func(u, filename) for u in user_ids]),
+                      ('count_records', count_records, lambda func: [func(filename) for _ in user_ids]),
+                      ('calculate_tax_batch', calculate_tax_batch, lambda func: [func(income, relief) for _ in user_ids])]
+        for name, wrapped, run in operations:
+            run(wrapped)   # warm up (builds the index)
+            timings = {}
+            for mode in ('raw', 'off', 'on', 'raw', 'off', 'on'):
+                metrics.enabled = mode == 'on'
+                seconds, _ = timed(run, wrapped.__wrapped__ if mode == 'raw' else wrapped)
+                timings[mode] = min(timings.get(mode, seconds), seconds)
+            metrics.disable()
+            raw, off, on = (timings[mode] / calls * 1e6 for mode in ('raw', 'off', 'on'))
+            print(f"{name:<22} {raw:>9.2f} {off:>9.2f} {on:>9.2f} {(off - raw) / raw:>8.1%} {(on - raw) / raw:>8.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for functions2")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    tax = commands.add_parser('tax', help="calculate_tax loop vs calculate_tax_batch")
+    tax.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000])
+    tax.add_argument('--loop-limit', type=int, default=1000000,
+                     help="largest size to run the per-row loop in full (bigger sizes are extrapolated)")
+
+    update = commands.add_parser('update', help="save_to_csv(update_existing=True) vs rewriting the file")
+    update.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    update.add_argument('--updates', type=int, default=200)
+
+    recalc = commands.add_parser('recalc', help="recalculate_records scaling over worker processes")
+    recalc.add_argument('--rows', type=int, default=1000000)
+    recalc.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    recalc.add_argument('--chunk-rows', type=int, default=50000)
+
+    rules = commands.add_parser('rules', help="calculate_tax bracket lookup vs the old if-chain")
+    rules.add_argument('--rows', type=int, default=1000000)
+
+    stress = commands.add_parser('stress', help="concurrent save_to_csv writers, checks no rows are lost")
+    stress.add_argument('--processes', type=int, default=4)
+    stress.add_argument('--threads', type=int, default=8)
+    stress.add_argument('--writes', type=int, default=100, help="users registered (and then updated) per thread")
+
+    service = commands.add_parser('service', help="load test the HTTP service (p50/p99 latency, requests/s)")
+    service.add_argument('--connections', type=int, default=32)
+    service.add_argument('--seconds', type=float, default=10)
+    service.add_argument('--rows', type=int, default=100000, help="ledger size for the local instance")
+    service.add_argument('--port', type=int, default=None, help="test an already running service instead")
+
+    memory = commands.add_parser('memory', help="bytes per record: DataFrame / dicts vs the compact TaxLedger")
+    memory.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+
+    startup = commands.add_parser('startup', help="import time, time to menu and first user lookup")
+    startup.add_argument('--runs', type=int, default=10)
+    startup.add_argument('--rows', type=int, default=1000000, help="ledger size for the lookup timings")
+
+    logins = commands.add_parser('logins', help="logins per second at each password hash cost")
+    logins.add_argument('--iterations', type=int, nargs='+', default=[10000, 100000, 310000, 600000])
+    logins.add_argument('--users', type=int, default=20)
+    logins.add_argument('--repeats', type=int, default=500, help="repeat logins per user (session cache)")
+
+    suite = commands.add_parser('suite', help="time the functions2 hot paths on 1k-10M row ledgers, as JSON")
+    suite.add_argument('--rows', type=int, nargs='+', default=SUITE_SIZES)
+    suite.add_argument('--calls', type=int, default=200, help="lookups / saves timed per operation")
+    suite.add_argument('--output', default='benchmark_results.json')
+    suite.add_argument('--data-dir', help="keep the generated ledgers here and reuse them")
+    suite.add_argument('--profile', action='store_true',
+                       help="also record peak allocations and the hottest functions of each operation")
+    suite.add_argument('--top', type=int, default=10, help="hot functions kept per operation with --profile")
+    suite.add_argument('--baseline', help="earlier results JSON to compare against")
+
+    metrics_parser = commands.add_parser('metrics', help="overhead of the metrics hooks, off and on")
+    metrics_parser.add_argument('--rows', type=int, default=100000)
+    metrics_parser.add_argument('--calls', type=int, default=20000)
+
+    whatif = commands.add_parser('whatif', help="what_if relief scenarios per second vs a calculate_tax loop")
+    whatif.add_argument('--scenarios', type=int, nargs='+', default=[1000, 10000, 100000])
+    whatif.add_argument('--year', type=int, default=DEFAULT_YEAR)
+
+    changes = commands.add_parser('changes', help="delta export of changed records vs a full export")
+    changes.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    changes.add_argument('--changes', type=int, nargs='+', default=[100, 1000, 10000])
+
+    args = parser.parse_args()
+    if args.command == 'tax':
+        bench_tax(args.sizes, args.loop_limit)
+    elif args.command == 'update':
+        bench_update(args.rows, args.updates)
+    elif args.command == 'recalc':
+        bench_recalc(args.rows, args.workers, args.chunk_rows)
+    elif args.command == 'rules':
+        bench_rules(args.rows)
+    elif args.command == 'service':
+        bench_service(args.connections, args.seconds, args.rows, args.port)
+    elif args.command == 'memory':
+        bench_memory(args.rows)
+    elif args.command == 'startup':
+        bench_startup(args.runs, args.rows)
+    elif args.command == 'logins':
+        bench_logins(args.iterations, args.users, args.repeats)
+    elif args.command == 'suite':
+        bench_suite(args.rows, args.calls, args.output, args.data_dir, args.profile, args.top, args.baseline)
+    elif args.command == 'metrics':
+        bench_metrics(args.rows, args.calls)
+    elif args.command == 'whatif':
+        bench_whatif(args.scenarios, args.year)
+    elif args.command == 'changes':
+        bench_changes(args.rows, args.changes)
+    elif args.command == 'stress':
+        if not bench_stress(args.processes, args.threads, args.writes):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+# credentials.py
+# Password hashes for the tax records, kept apart from the records themselves.
+# Each user's password is stored as a salted PBKDF2-SHA256 hash in an append-only file next
+# to the records (tax_records.csv -> tax_records.credentials), one JSON line per user and the
+# last line for an ID wins. The cost (iterations) is tunable; every hash records its own cost,
+# so raising it later only rehashes a user's password the next time they log in.
+# Verifying a password means running the slow hash, so a successful login is remembered in a
+# small session cache for a few minutes and repeat checks in the same session skip it.
+# start_session() hands out a random token for a verified user that is good for the same few
+# minutes, so a client (e.g. tax_service.py) can prove who it is without sending the password again.
+# Usage: python credentials.py migrate --records tax_records.csv
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from file_lock import file_lock
+
+CREDENTIALS_SUFFIX = '.credentials'
+
+# PBKDF2 iterations for new hashes (OWASP's figure for PBKDF2-SHA256); TAX_PASSWORD_ITERATIONS overrides it
+DEFAULT_ITERATIONS = int(os.environ.get('TAX_PASSWORD_ITERATIONS', 600000))
+SALT_BYTES = 16
+
+# Verified sessions: how many to remember and for how long (seconds)
+SESSION_CACHE_SIZE = 4096
+SESSION_TTL = 900
+
+
+# Hash a password with a new random salt, as 'pbkdf2_sha256$iterations$salt$hash'
+def hash_password(password, iterations=DEFAULT_ITERATIONS, salt=None):
+    salt = os.urandom(SALT_BYTES) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return '$'.join(['pbkdf2_sha256', str(iterations),
+                     base64.b64encode(salt).decode('ascii'), base64.b64encode(digest).decode('ascii')])
+
+
+# Check a password against a hash made by hash_password (constant-time compare)
+def check_password(password, encoded):
+    try:
+        algorithm, iterations, salt, digest = encoded.split('$')
+    except (AttributeError, ValueError):
+        return False
+    if algorithm != 'pbkdf2_sha256':
+        return False
+    expected = base64.b64decode(digest)
+    actual = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(actual, expected)
+
+
+# Iterations a hash was made with
+def hash_iterations(encoded):
+    return int(encoded.split('$')[1])
+
+
+# Credentials file that goes with a records file
+def credentials_file(records_file):
+    return os.path.splitext(records_file)[0] + CREDENTIALS_SUFFIX
+
+
+class CredentialStore:
+
+    def __init__(self, filename, iterations=DEFAULT_ITERATIONS,
+                 session_size=SESSION_CACHE_SIZE, session_ttl=SESSION_TTL):
+        self.filename = filename
+        self.iterations = iterations
+        self.session_size = session_size
+        self.session_ttl = session_ttl
+        self._hashes = {}            # user ID -> encoded hash
+        self._read_to = 0            # bytes of the file loaded into _hashes
+        self._inode = None
+        # user ID -> (keyed digest of the password, the hash it was checked against, expiry time).
+        # The digest uses a key that only lives in this process, so the cache never holds
+        # anything that could be used to recover a password.
+        self._sessions = OrderedDict()
+        # keyed digest of a session token -> (user ID, expiry time); only digests are kept here too
+        self._tokens = OrderedDict()
+        self._session_key = secrets.token_bytes(32)
+        self._lock = threading.Lock()
+
+    # Pick up lines other sessions appended since we last looked (or reload if the file was replaced)
+    def _refresh(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            self._hashes, self._read_to, self._inode = {}, 0, None
+            return
+        if stat.st_ino != self._inode or stat.st_size < self._read_to:
+            self._hashes, self._read_to, self._inode = {}, 0, stat.st_ino
+        if stat.st_size == self._read_to:
+            return
+        with open(self.filename, 'rb') as f:
+            f.seek(self._read_to)
+            data = f.read(stat.st_size - self._read_to)
+        # only take whole lines; a line still being written is picked up next time
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                self._hashes[entry['id']] = entry['hash']
+        self._read_to += end
+
+    # The stored hash for a user, or None
+    def get_hash(self, user_id):
+        with self._lock:
+            self._refresh()
+            return self._hashes.get(str(user_id))
+
+    def has(self, user_id):
+        return self.get_hash(user_id) is not None
+
+    # IDs of every user with a stored hash
+    def user_ids(self):
+        with self._lock:
+            self._refresh()
+            return set(self._hashes)
+
+    # Store hashes for {user ID: password} in one append (the hashing happens before the lock)
+    def set_passwords(self, passwords):
+        lines = [json.dumps({'id': str(user_id), 'hash': hash_password(password, self.iterations)}) + '\n'
+                 for user_id, password in passwords.items()]
+        self._append(''.join(lines).encode('utf-8'))
+        with self._lock:
+            for user_id in passwords:
+                self._sessions.pop(str(user_id), None)
+            changed = {str(user_id) for user_id in passwords}
+            for digest in [digest for digest, session in self._tokens.items() if session[0] in changed]:
+                del self._tokens[digest]
+
+    def set_password(self, user_id, password):
+        self.set_passwords({user_id: password})
+
+    def _append(self, data):
+        with file_lock(self.filename):
+            with open(self.filename, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    # True if the password is right for this user. A repeat check within session_ttl of a
+    # successful one is answered from the session cache instead of rehashing.
+    def verify(self, user_id, password):
+        user_id = str(user_id)
+        digest = hmac.new(self._session_key, password.encode('utf-8'), hashlib.sha256).digest()
+        with self._lock:
+            self._refresh()
+            encoded = self._hashes.get(user_id)
+            if encoded is None:
+                return False
+            session = self._sessions.get(user_id)
+            if session is not None:
+                if session[2] > time.monotonic() and session[1] == encoded and hmac.compare_digest(session[0], digest):
+                    self._sessions.move_to_end(user_id)
+                    metrics.count('cache_hits_total', cache='login_session')
+                    return True
+                del self._sessions[user_id]
+        metrics.count('cache_misses_total', cache='login_session')
+
+        if not check_password(password, encoded):
+            return False
+        if hash_iterations(encoded) < self.iterations:
+            # made with a lower cost than we use now: store a stronger hash while we have the password
+            self.set_password(user_id, password)
+            encoded = self.get_hash(user_id)
+
+        with self._lock:
+            self._sessions[user_id] = (digest, encoded, time.monotonic() + self.session_ttl)
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.session_size:
+                self._sessions.popitem(last=False)
+        return True
+
+    # New session token for a user whose password was just verified; valid for session_ttl seconds
+    def start_session(self, user_id):
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._tokens[self._token_digest(token)] = (str(user_id), time.monotonic() + self.session_ttl)
+            while len(self._tokens) > self.session_size:
+                self._tokens.popitem(last=False)
+        return token
+
+    # True if the token came from start_session() for this user and hasn't expired
+    def check_session(self, token, user_id):
+        if not token:
+            return False
+        digest = self._token_digest(token)
+        with self._lock:
+            session = self._tokens.get(digest)
+            if session is None:
+                return False
+            if session[1] <= time.monotonic():
+                del self._tokens[digest]
+                return False
+        return hmac.compare_digest(session[0].encode('utf-8'), str(user_id).encode('utf-8'))
+
+    def _token_digest(self, token):
+        return hmac.new(self._session_key, token.encode('utf-8'), hashlib.sha256).digest()
+
+    # Forget a user's verified session and tokens (e.g. on logout)
+    def end_session(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            self._sessions.pop(user_id, None)
+            for digest in [digest for digest, session in self._tokens.items() if session[0] == user_id]:
+                del self._tokens[digest]
+
+
+# One store per credentials file, shared by every thread in this process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_credential_store(records_file):
+    filename = credentials_file(records_file)
+    with _stores_lock:
+        store = _stores.get(filename)
+        if store is None:
+            store = _stores[filename] = CredentialStore(filename)
+        return store
+
+
+# Move the plaintext passwords out of a records file: hash every stored password into the
+# credentials file (unless enroll=False), then rewrite the records without the password column.
+# Users left without a hash are enrolled the first time they log in (see functions2.authenticate_user).
+# Returns the number of passwords hashed.
+def migrate_passwords(records_file, enroll=True, workers=None):
+    from concurrent.futures import ThreadPoolExecutor
+    from functions2 import read_from_csv, replace_records
+
+    store = get_credential_store(records_file)
+    with file_lock(records_file):
+        df = read_from_csv(records_file)
+        if df is None or 'password' not in df:
+            return 0
+        passwords = {}
+        if enroll:
+            ids = df['id'].astype(str)
+            todo = df['password'].notna() & ~ids.isin(store.user_ids())
+            for user_id, password in zip(ids[todo], df['password'][todo]):
+                # read_csv turns the 4 digit passwords into numbers, losing leading zeros
+                password = str(password).removesuffix('.0')
+                passwords[user_id] = password.zfill(4) if password.isdigit() else password
+        # hashlib releases the GIL while hashing, so threads use every core
+        items = list(passwords.items())
+        batch = 1000
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda start: store.set_passwords(dict(items[start:start + batch])),
+                          range(0, len(items), batch)))
+        replace_records(df.drop(columns='password'), records_file)
+    return len(passwords)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Password hashes for the tax records")
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help="hash the plaintext passwords and drop them from the records")
+    migrate.add_argument('--records', default='tax_records.csv')
+    migrate.add_argument('--no-enroll', action='store_true',
+                         help="only drop the column; users are enrolled when they next log in")
+    migrate.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    count = migrate_passwords(args.records, not args.no_enroll, args.workers)
+    print(f"Hashed {count:,} passwords into {credentials_file(args.records)} and removed the password "
+          f"column from {args.records} in {time.perf_counter() - start:.1f}s")
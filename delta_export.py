@@ -0,0 +1,74 @@
+# delta_export.py
+# Export only the tax records that changed since the last sync, for jobs (like the nightly
+# reconciliation) that keep their own copy of the ledger. Every save stamps the rows it writes
+# with the next change_seq (see functions2), so a sync only has to remember the highest
+# change_seq it has seen and ask for what came after it.
+# Output is NDJSON: one JSON object per line, the current version of each changed record,
+# oldest change first, change_seq included.
+# Usage: python delta_export.py --since 0 --output changes.ndjson
+#        python delta_export.py --checkpoint reconcile.checkpoint --output changes.ndjson
+#        (reads where the last run got to, and moves the checkpoint on once the export is written)
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import metrics
+from functions2 import CHANGE_SEQ, RECORDS_FILE, iter_changes
+
+
+# One JSON line per record (missing values become null)
+def _ndjson(chunk):
+    rows = chunk.astype(object).where(chunk.notna(), None).to_dict('records')
+    return ''.join(json.dumps(row, separators=(',', ':')) + '\n' for row in rows)
+
+
+# Write the records changed since `since` to a text file as NDJSON.
+# Returns (records written, checkpoint to pass as `since` next time).
+@metrics.timed('export_changes')
+def export_changes(output, since=0, filename=RECORDS_FILE, chunksize=10000):
+    written, checkpoint = 0, since
+    for chunk in iter_changes(since, filename, chunksize):
+        output.write(_ndjson(chunk))
+        written += len(chunk)
+        if CHANGE_SEQ in chunk:
+            checkpoint = max(checkpoint, int(chunk[CHANGE_SEQ].max()))
+    return written, checkpoint
+
+
+# Checkpoint saved by an earlier export (0 if there is none yet)
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, checkpoint):
+    with open(path + '.tmp', 'w') as f:
+        f.write(f'{checkpoint}\n')
+    os.replace(path + '.tmp', path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export tax records changed since a checkpoint as NDJSON")
+    parser.add_argument('--records', default=RECORDS_FILE)
+    parser.add_argument('--since', type=int, default=None, help="export changes after this change_seq")
+    parser.add_argument('--checkpoint', help="file holding the change_seq to start from; updated after the export")
+    parser.add_argument('--output', default='-', help="NDJSON file to write (default: standard output)")
+    args = parser.parse_args()
+
+    since = args.since if args.since is not None else read_checkpoint(args.checkpoint) if args.checkpoint else 0
+    start = time.perf_counter()
+    if args.output == '-':
+        written, checkpoint = export_changes(sys.stdout, since, args.records)
+    else:
+        with open(args.output, 'w') as output:
+            written, checkpoint = export_changes(output, since, args.records)
+    if args.checkpoint:
+        write_checkpoint(args.checkpoint, checkpoint)
+    print(f"Exported {written:,} changed records since change {since:,} in {time.perf_counter() - start:.2f}s; "
+          f"next checkpoint: {checkpoint}", file=sys.stderr)
@@ -0,0 +1,124 @@
+# file_lock.py
+# Keeps several sessions from corrupting tax_records.csv when they write at the same time.
+# file_lock() takes an advisory lock on <filename>.lock (works across processes), and
+# GroupCommit lets threads queue up writes so one of them commits the whole queue at once.
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+LOCK_SUFFIX = '.lock'
+
+# Locks this thread already holds, so nested file_lock() calls don't deadlock
+_held = threading.local()
+
+
+def _lock_fd(fd, shared):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    else:
+        # msvcrt only has exclusive locks
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+
+
+def _unlock_fd(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+# Hold the lock for a file inside a `with` block.
+# shared=True lets many readers in at once; writers need it exclusive.
+# Yields how long we waited for the lock, in seconds.
+@contextmanager
+def file_lock(filename, shared=False):
+    held = getattr(_held, 'files', None)
+    if held is None:
+        held = _held.files = {}
+    path = os.path.abspath(filename)
+    if path in held:
+        # this thread already has it
+        held[path] += 1
+        try:
+            yield 0.0
+        finally:
+            held[path] -= 1
+        return
+
+    fd = os.open(path + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+    start = time.perf_counter()
+    try:
+        _lock_fd(fd, shared)
+        waited = time.perf_counter() - start
+        metrics.observe('lock_wait_seconds', waited, mode='shared' if shared else 'exclusive')
+        held[path] = 1
+        try:
+            yield waited
+        finally:
+            del held[path]
+            _unlock_fd(fd)
+    finally:
+        os.close(fd)
+
+
+# Collects writes from the threads of one process and commits them in groups (separate
+# processes still take turns on the file lock, one commit each).
+# commit(items) is called with every item queued since the last commit; each submit()
+# returns once its item has been committed (or raises the error the commit raised).
+# commit may also return a list with an exception (or None) per item to fail single items.
+class GroupCommit:
+
+    def __init__(self, commit):
+        self._commit = commit
+        self._lock = threading.Lock()
+        self._queue = []
+        self._leader = False
+
+    def submit(self, item):
+        entry = {'item': item, 'wake': threading.Event(), 'lead': False, 'error': None}
+        with self._lock:
+            self._queue.append(entry)
+            if not self._leader:
+                self._leader = entry['lead'] = True
+
+        if not entry['lead']:
+            # another thread is committing; it either commits this item or hands over to us
+            entry['wake'].wait()
+        if entry['lead']:
+            self._commit_batch()
+
+        if entry['error'] is not None:
+            raise entry['error']
+
+    # Commit everything queued so far (the leader's own item included), then make the
+    # next waiting thread the leader, so no thread keeps committing other threads' writes
+    def _commit_batch(self):
+        try:
+            with self._lock:
+                batch, self._queue = self._queue, []
+            try:
+                errors = self._commit([queued['item'] for queued in batch]) or [None] * len(batch)
+            except BaseException as e:
+                errors = [e] * len(batch)
+            for queued, error in zip(batch, errors):
+                queued['error'] = error
+                queued['wake'].set()
+        finally:
+            with self._lock:
+                if self._queue:
+                    self._queue[0]['lead'] = True
+                    self._queue[0]['wake'].set()
+                else:
+                    self._leader = False
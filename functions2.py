@@ -1,8 +1,23 @@
 # functions.py
 # Contains helper functions for Malaysian Tax Input Program
 
-import pandas as pd
+import io
 import os
+import threading
+from bisect import bisect_left
+
+# pandas and numpy are imported inside the functions that use them, so starting the
+# program (and showing the menu) doesn't wait for them to load
+import metrics
+from credentials import get_credential_store
+from file_lock import GroupCommit, file_lock
+from record_index import get_index, invalidate_index
+from storage_backends import is_columnar, read_columnar, write_columnar, iter_columnar
+from tax_rules import DEFAULT_YEAR, get_tax_rules, validate_relief
+
+# Where the tax records are kept. Set TAX_RECORDS_FILE to e.g. tax_records.parquet
+# to use a columnar backend (see storage_backends.migrate_csv to convert the CSV)
+RECORDS_FILE = os.environ.get('TAX_RECORDS_FILE', 'tax_records.csv')
 
 # Verify user's credentials by checking IC number format and password
 def verify_user( ic_number, password):
@@ -15,92 +30,111 @@ def verify_user( ic_number, password):
     return False
 
 
-# Calculate tax payable based on Malaysian tax rates for 2024 
+# Calculate tax payable based on Malaysian tax rates (2024 unless another year is given)
 # Chargable income applied to Mlaysian Progressive Tax Rates
-# Tax Brackets (Based on LHDN)
-def calculate_tax(income, tax_relief):
+# Tax Brackets (Based on LHDN) come from tax_rules.json, e.g. for 2024:
+#   A: 0 - 5,000 (0%)              B: 5,001 - 20,000 (1%)         C: 20,001 - 35,000 (3%)
+#   D: 35,001 - 50,000 (6%)        E: 50,001 - 70,000 (11%)       F: 70,001 - 100,000 (19%)
+#   G: 100,001 - 400,000 (25%)     H: 400,001 - 600,000 (26%)     I: 600,001 - 2,000,000 (28%)
+#   J: More than 2,000,000 (30%)
+def calculate_tax(income, tax_relief, year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
     chargeable_income = income - tax_relief
 
-    # Bracket A: 0 - 5,000 (Rate 0%)
-    if chargeable_income <= 5000:
+    # Bracket A: nothing to pay
+    if chargeable_income <= rules.tax_free:
         return 0.0
-    tax_payable = 0.0
-    
-    # Bracket B: 5,001 - 20,000 (Rate 1%)
-    if chargeable_income > 5000:
-        taxable_amount = min(chargeable_income, 20000) - 5000
-        tax_payable += taxable_amount * 0.01
-    
-    # Brcket C: 20,001 - 35,000 (Rate 3%)
-    if chargeable_income > 20000:
-        taxable_amount = min(chargeable_income, 35000) - 20000
-        tax_payable += taxable_amount * 0.03
-    
-    # Bracket D: 35,001 - 50,000 (Rate 6%)
-    if chargeable_income > 35000:
-        taxable_amount = min(chargeable_income, 50000) - 35000
-        tax_payable += taxable_amount * 0.06
-    
-    # Bracket E: 50,001 - 70,000 (Rate 11%)
-    if chargeable_income > 50000:
-        taxable_amount = min(chargeable_income, 70000) - 50000
-        tax_payable += taxable_amount * 0.11
-    
-    # Bracket F: 70,001 - 100,000 (Rate 19%)
-    if chargeable_income > 70000:
-        taxable_amount = min(chargeable_income, 100000) - 70000
-        tax_payable += taxable_amount * 0.19
-    
-    # Brcket G: 100,001 - 400,000 (Rate 25%)
-    if chargeable_income > 100000:
-        taxable_amount = min(chargeable_income, 400000) - 100000
-        tax_payable += taxable_amount * 0.25
-    
-    # Bracket H: 400,001 - 600,000 (Rate 26%)
-    if chargeable_income > 400000:
-        taxable_amount = min(chargeable_income, 600000) - 400000
-        tax_payable += taxable_amount * 0.26
-    
-    # Bracket I: 600,001 - 2,000,000 (Rate 28%)
-    if chargeable_income > 600000:
-        taxable_amount = min(chargeable_income, 2000000) - 600000
-        tax_payable += taxable_amount * 0.28
-    
-    # Bracket J: More  than 2,000,000 (Rate 30%)
-    if chargeable_income > 2000000:
-        taxable_amount = chargeable_income - 2000000
-        tax_payable += taxable_amount * 0.30
-    
+
+    # Find the bracket, then add the tax already owed below it
+    k = bisect_left(rules.lowers, chargeable_income) - 1
+    tax_payable = rules.base[k] + (chargeable_income - rules.lowers[k]) * rules.rates[k]
     return round(tax_payable, 2)
 
 
-# Individual tax relief amounts
-def tax_relief():
+# Round an array of positive amounts to 2 decimals exactly like Python's round(x, 2).
+# np.round can land on the wrong side of a half cent, so values close to one are
+# settled by comparing x * 200 with the odd midpoint using an exact (Dekker) product.
+def _round_cents(values):
+    import numpy as np
+    scaled = values * 100
+    cents = np.rint(scaled)
+    floor = np.floor(scaled)
+    near = np.abs(scaled - floor - 0.5) < 1e-6
+    if near.any():
+        x = values[near]
+        midpoint = 2 * floor[near] + 1
+        product = x * 200
+        # Split x so x * 200 can be rebuilt without rounding error
+        split = x * 134217729.0
+        high = split - (split - x)
+        low = x - high
+        error = (high * 200 - product) + low * 200
+        side = np.sign((product - midpoint) + error)
+        # Above the midpoint rounds up, exact ties go to the even cent like round()
+        up = (side > 0) | ((side == 0) & (floor[near] % 2 == 1))
+        cents[near] = floor[near] + up
+    return cents / 100
+
+
+# Calculate tax for many payers in one pass (numpy arrays, lists or pandas Series).
+# Returns (chargeable_income, tax_payable) arrays matching calculate_tax to the cent.
+@metrics.timed('calculate_tax_batch')
+def calculate_tax_batch(income, tax_relief, year=DEFAULT_YEAR):
+    import numpy as np
+    rules = get_tax_rules(year)
+    income = np.asarray(income, dtype=np.float64)
+    tax_relief = np.asarray(tax_relief, dtype=np.float64)
+    chargeable_income = income - tax_relief
+
+    # Find each payer's bracket then add the cumulative tax below it
+    bracket = np.searchsorted(rules.lowers_array, chargeable_income, side='left') - 1
+    bracket = np.clip(bracket, 0, len(rules.lowers) - 1)
+    tax_payable = rules.base_array[bracket] + (chargeable_income - rules.lowers_array[bracket]) * rules.rates_array[bracket]
+
+    # Bracket A (and any negative chargeable income) pays no tax
+    taxed = chargeable_income > rules.tax_free
+    tax_payable = np.where(taxed, tax_payable, 0.0)
+    tax_payable[taxed] = _round_cents(tax_payable[taxed])
+    return np.maximum(chargeable_income, 0), tax_payable
+
+
+# Columns of a saved tax record, in the order calculate_and_save_tax builds them
+# (passwords are not part of the record, they are hashed into the credential store, see credentials.py)
+RECORD_COLUMNS = ['id', 'ic_number', 'income', 'individual_relief', 'spouse_relief',
+                  'child_relief', 'num_children', 'medical_relief', 'lifestyle_relief',
+                  'education_relief', 'parental_relief', 'total_relief', 'chargeable_income',
+                  'tax_payable']
+
+# Every row written gets the next number in this column (the last one in the file), so rows
+# stay in change order and a job that copies the records can read just the ones changed
+# since it last looked (see iter_changes)
+CHANGE_SEQ = 'change_seq'
+
+# How the records CSV is read: IDs and IC numbers stay text (keeping leading zeros), and only
+# empty cells count as missing, so pandas doesn't turn an ID like "NA" or "null" into NaN
+CSV_READ_OPTIONS = {'dtype': {'id': str, 'ic_number': str}, 'keep_default_na': False, 'na_values': ['']}
+
+
+# Individual tax relief amounts (limits for the given assessment year)
+def tax_relief(year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
+
     # Prompt user to enter individual tax relief amounts
     print("\n" + "============================================================")
     print("   ENTER YOUR TAX RELIEF DETAILS")
     print("============================================================")
     
-    # Define tax relief using a LIST of TUPLES (define name, max amount, name, description)
-    relief_types = [
-        ('individual_relief', 9000, 'Individual Relief', 'Every Tax Payer Individual will get RM9,000 relief'),
-        ('spouse_relief', 4000, 'Spouse Relief', 'Up to RM4,000 for spouse with no/low income'),
-        ('medical_relief', 8000, 'Medical Expenses Relief', 'Up to RM8,000 for self, spouse or child'),
-        ('lifestyle_relief', 2500, 'Lifestyle Relief', 'Up to RM2,500 for Books, sports, computer, smartphone, internet sub purchase'),
-        ('education_relief', 7000, 'Education Fees Relief', 'Up to RM7,000'),
-        ('parental_relief', 5000, 'Parental Care Relief', 'Up to RM5,000')]
-    
     # Use set to see which reliefs were claimed
     reliefs = {}
     relief_names = set()  
     
     # Process each relief type using LIST OF TUPLES
-    for index, (define_name, max_amount, name, description) in enumerate(relief_types, 1):
+    for index, (define_name, max_amount, name, description) in enumerate(rules.reliefs, 1):
         print(f"\n{index}. {name} ({description})")
         while True:
             try:
                 amount = float(input(f"   Enter amount (0-{max_amount}): RM "))
-                if 0 <= amount <= max_amount:
+                if validate_relief(define_name, amount, year):
                     reliefs[define_name] = amount
                     if amount > 0:
                         relief_names.add(name)  # Add to SET if claimed
@@ -110,29 +144,22 @@ def tax_relief():
                 print("   Error: Please enter a valid number")
     
     # Child relief (special case - based on number of children)
-    print("\n7. Child Relief (RM8,000 per child, max 12 children)")
+    print(f"\n{len(rules.reliefs) + 1}. Child Relief (RM{rules.child_relief:,} per child, max {rules.max_children} children)")
     while True:
         try:
-            num_children = int(input("   How many children? (0-12): "))
-            if 0 <= num_children <= 12:
-                reliefs['child_relief'] = num_children * 8000
+            num_children = int(input(f"   How many children? (0-{rules.max_children}): "))
+            if validate_relief('num_children', num_children, year):
+                reliefs['child_relief'] = num_children * rules.child_relief
                 reliefs['num_children'] = num_children
                 if num_children > 0:
                     relief_names.add('Child Relief')
                 break
-            print("   Error: Number must be between 0 and 12")
+            print(f"   Error: Number must be between 0 and {rules.max_children}")
         except ValueError:
             print("   Error: Please enter a valid number")
     
-    # Calculate total relief using a list
-    relief_values = [
-        reliefs.get('individual_relief', 0),
-        reliefs.get('spouse_relief', 0),
-        reliefs.get('child_relief', 0),
-        reliefs.get('medical_relief', 0),
-        reliefs.get('lifestyle_relief', 0),
-        reliefs.get('education_relief', 0),
-        reliefs.get('parental_relief', 0)]
+    # Calculate total relief using a list (every relief of the year, plus child relief)
+    relief_values = [reliefs.get(column, 0) for column in rules.relief_columns]
     reliefs['total_relief'] = sum(relief_values)
     
     # Store the set of claimed relief names 
@@ -147,9 +174,204 @@ def tax_relief():
     return reliefs
 
 
+# Compact the file automatically once at least this many old versions pile up
+# and they make up half of the file
+COMPACT_MIN_ROWS = 1000
+
+
+# Render rows as CSV text exactly like DataFrame.to_csv(header=False, index=False),
+# but about twice as fast for plain numbers and text. Anything that is missing or
+# would need quoting falls back to to_csv.
+def format_csv_rows(df):
+    columns = []
+    for name in df.columns:
+        values = df[name]
+        if values.isna().any():
+            return df.to_csv(header=False, index=False, lineterminator='\n')
+        kind = values.dtype.kind
+        if kind == 'f':
+            columns.append(list(map(float.__repr__, values.tolist())))
+        elif kind in 'iub':
+            columns.append(list(map(str, values.tolist())))
+        else:
+            text = values.astype(str)
+            if text.str.contains('[,"\r\n]').any():
+                return df.to_csv(header=False, index=False, lineterminator='\n')
+            columns.append(text.tolist())
+    return '\n'.join(map(','.join, zip(*columns))) + '\n'
+
+
+# Append rows to an existing CSV in one write and add them to the lookup index.
+# The caller must hold the file lock.
+def _append_rows(new_df, filename):
+    index = get_index(filename)
+    # keep the same column order as the file's header
+    if index.columns:
+        new_df = new_df.reindex(columns=index.columns)
+    text = format_csv_rows(new_df)
+    if not index.ends_with_newline:
+        text = '\n' + text
+    data = text.encode('utf-8')
+
+    with open(filename, 'ab') as f:
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    index.note_append(offset, data)
+    metrics.count('rows_written_total', len(new_df))
+    metrics.count('bytes_written_total', len(data))
+    return index
+
+
+# Write a complete CSV to a temporary file and swap it in, so nobody ever sees half a file.
+# The caller must hold the file lock.
+def _replace_csv(df, filename):
+    temp_name = filename + '.tmp'
+    with open(temp_name, 'w', newline='') as f:
+        df.to_csv(f, index=False, lineterminator='\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, filename)
+    invalidate_index(filename)
+    metrics.count('rows_written_total', len(df))
+    metrics.count('bytes_written_total', os.path.getsize(filename))
+
+
+# Highest change_seq in a CSV: the one on its last row, since rows are kept in change order
+def _last_change_seq(index):
+    row = index.last_row()
+    return int(index.parse_row(row)[CHANGE_SEQ]) if row is not None else 0
+
+
+# Number rows last_seq + 1, last_seq + 2, ... in the change_seq column (moved to the end)
+def _with_change_seq(df, last_seq):
+    df = df.drop(columns=CHANGE_SEQ, errors='ignore')
+    df[CHANGE_SEQ] = range(last_seq + 1, last_seq + 1 + len(df))
+    return df
+
+
+# Current rows of the given users (those already in the file), read through the index
+def _current_rows(index, user_ids):
+    import pandas as pd
+    lines = [index.read_row(user_id) for user_id in user_ids if str(user_id) in index.ids]
+    if not lines:
+        return None
+    return pd.read_csv(io.StringIO(index.header + '\n' + '\n'.join(lines)), **CSV_READ_OPTIONS)
+
+
+# A new record for a user ID that is already taken
+class UserExistsError(ValueError):
+    pass
+
+
+# Commit a group of queued writes, each a (DataFrame, update_existing) pair, under the file lock.
+# A write of new users (update_existing=False) whose IDs are already in the file, or earlier in
+# the same group, is left out and gets a UserExistsError. Returns the error (or None) per write.
+# Also keeps the running report totals (see reporting.py) in step with the file.
+@metrics.timed('commit')
+def _commit_writes(filename, writes):
+    import pandas as pd
+    from reporting import running_totals_current, update_running_totals
+    metrics.observe('commit_writes', len(writes), buckets=metrics.SIZE_BUCKETS)
+    with file_lock(filename):
+        index = None if is_columnar(filename) else get_index(filename)
+        if index is not None and index.header is not None and CHANGE_SEQ not in index.columns:
+            # written before change sequences: number the existing records first
+            add_change_seq(filename)
+
+        # checked here, under the lock, so two sessions registering the same ID at once can't both win
+        writes, errors = _reject_taken_ids(filename, writes)
+        if not writes:
+            return errors
+        new_df = pd.concat([df for df, _ in writes], ignore_index=True)
+        before = os.stat(filename) if os.path.exists(filename) else None
+        before = [before.st_size, before.st_mtime_ns] if before else None
+        # only look up the old versions of the users if the totals are worth keeping
+        track = before is not None and running_totals_current(filename, before)
+        added = new_df.drop_duplicates('id', keep='last') if track and 'id' in new_df else None
+        replaced = None
+
+        if is_columnar(filename):
+            # Columnar files can't be appended to, so replace updated users' rows and write the table again
+            existing_df = read_columnar(filename)
+            last_seq = 0
+            if existing_df is not None:
+                if CHANGE_SEQ not in existing_df:
+                    existing_df[CHANGE_SEQ] = range(1, len(existing_df) + 1)
+                last_seq = int(existing_df[CHANGE_SEQ].max()) if len(existing_df) else 0
+                updated = [user_id for df, update in writes if update and 'id' in df for user_id in df['id']]
+                if track:
+                    replaced = existing_df[existing_df['id'].isin(updated)]
+                existing_df = existing_df[~existing_df['id'].isin(updated)]
+                new_df = pd.concat([existing_df, _with_change_seq(new_df, last_seq)], ignore_index=True)
+            else:
+                new_df = _with_change_seq(new_df, 0)
+            write_columnar(new_df, filename)
+            metrics.count('rows_written_total', len(new_df))
+            metrics.count('bytes_written_total', os.path.getsize(filename))
+        elif index is None or index.header is None:
+            # File doesn't exist (or is empty) - create with header
+            _replace_csv(_with_change_seq(new_df, 0), filename)
+        else:
+            # Updates are appended too: readers take the last row for each ID, and
+            # compact_records() folds the old versions away once they pile up
+            index = get_index(filename)
+            if track:
+                replaced = _current_rows(index, added['id'])
+            _append_rows(_with_change_seq(new_df, _last_change_seq(index)), filename)
+
+        if track:
+            update_running_totals(filename, before, added, replaced)
+    return errors
+
+
+# Split writes into the ones to commit and an error (or None) for every write
+def _reject_taken_ids(filename, writes):
+    if is_columnar(filename):
+        existing = read_columnar(filename, columns=['id'])
+        taken = set() if existing is None else set(existing['id'].astype(str))
+    else:
+        index = get_index(filename)
+        taken = set() if index is None else index.ids
+    batch_ids = set()
+    accepted, errors = [], []
+    for df, update in writes:
+        ids = df['id'].astype(str).tolist() if 'id' in df else []
+        if not update:
+            clash = [user_id for user_id in ids if user_id in taken or user_id in batch_ids]
+            if clash or len(set(ids)) < len(ids):
+                user_id = clash[0] if clash else next(i for i in ids if ids.count(i) > 1)
+                errors.append(UserExistsError(f"User ID '{user_id}' already exists"))
+                continue
+        batch_ids.update(ids)
+        accepted.append((df, update))
+        errors.append(None)
+    return accepted, errors
+
+
+# One group-commit queue per file, shared by every thread in this process
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+# Queue rows to be written to the file and wait until they are safely on disk.
+# Writes from other threads that arrive at the same time go out in the same commit.
+def _write_records(new_df, filename, update_existing=False):
+    with _writers_lock:
+        writer = _writers.get(filename)
+        if writer is None:
+            writer = _writers[filename] = GroupCommit(lambda writes: _commit_writes(filename, writes))
+    writer.submit((new_df, update_existing))
+
+
 # Save user data to CSV file. Creates new file if doesn't exist appends if file exists.
-def save_to_csv(data, filename='tax_records.csv', update_existing=False):
+# Files ending in .parquet or .feather are stored in that columnar format instead.
+# Safe to call from several sessions at once: writes are locked and never interleave.
+@metrics.timed('save_to_csv')
+def save_to_csv(data, filename=RECORDS_FILE, update_existing=False):
 
+    import pandas as pd
     try:
         # Ensure IC number is stored as string (preserve leading zeros)
         if 'ic_number' in data:
@@ -161,72 +383,453 @@ def save_to_csv(data, filename='tax_records.csv', update_existing=False):
         # Set ic_number column as string dtype
         new_df['ic_number'] = new_df['ic_number'].astype(str)
         
-        # Check if file exists
-        try:
-            existing_df = pd.read_csv(filename, dtype={'ic_number': str})
-            if update_existing and 'id' in data:
-                # Update existing record for this user
-                user_id = data['id']
-                
-                # Remove old record for this user
-                existing_df = existing_df[existing_df['id'] != user_id]
-                
-                # Add new record
-                combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-                combined_df.to_csv(filename, index=False)
-                print(f"✓ Updated existing record for user '{user_id}'")
-            else:
-                # Append new record
-                new_df.to_csv(filename, mode='a', header=False, index=False)
-                
-        except FileNotFoundError:
-            # File doesn't exist - create with header
-            new_df.to_csv(filename, mode='w', header=True, index=False)
+        update_existing = update_existing and 'id' in data
+        _write_records(new_df, filename, update_existing)
+
+        if update_existing:
+            # Update existing record for this user
+            if not is_columnar(filename):
+                index = get_index(filename)
+                if index.superseded >= COMPACT_MIN_ROWS and index.superseded * 2 >= index.row_count:
+                    compact_records(filename)
+            print(f"✓ Updated existing record for user '{data['id']}'")
         
         return True
     except Exception as e:
+        metrics.count('operation_errors_total', operation='save_to_csv')
         print(f"Error saving to CSV: {e}")
         return False
     
 
+# Save many records (a DataFrame with the RECORD_COLUMNS) in a single write
+@metrics.timed('save_many_to_csv')
+def save_many_to_csv(records, filename=RECORDS_FILE):
+    try:
+        _write_records(records.astype({'ic_number': str}), filename)
+        return True
+    except Exception as e:
+        metrics.count('operation_errors_total', operation='save_many_to_csv')
+        print(f"Error saving to CSV: {e}")
+        return False
+
+
 # Read data from CSV file and return as pandas DataFrame
-def read_from_csv(filename='tax_records.csv'):
+# columns: only load these columns (all of them if None)
+@metrics.timed('read_from_csv')
+def read_from_csv(filename=RECORDS_FILE, columns=None):
+    import pandas as pd
     try:
-        # Try to read the CSV file
-        df = pd.read_csv(filename, dtype={'ic_number': str})
+        if is_columnar(filename):
+            df = read_columnar(filename, columns)
+            if df is not None:
+                metrics.count('rows_read_total', len(df), operation='read_from_csv')
+            return df
+
+        # Try to read the CSV file (the id column is always needed to find the latest versions)
+        usecols = None if columns is None else list(dict.fromkeys(['id'] + list(columns)))
+        with file_lock(filename, shared=True):
+            df = pd.read_csv(filename, usecols=usecols, **CSV_READ_OPTIONS)
+        # Updated records are appended, keep only the latest version of each user
+        if df['id'].duplicated().any():
+            df = df.drop_duplicates('id', keep='last').reset_index(drop=True)
+        if columns is not None:
+            df = df[list(columns)]
+        metrics.count('rows_read_total', len(df), operation='read_from_csv')
         return df
     except FileNotFoundError:
         return None
     except Exception as e:
+        metrics.count('operation_errors_total', operation='read_from_csv')
         print(f"Error reading CSV: {e}")
         return None
 
 
+# Number of users with a record (the latest version of each user counts once)
+@metrics.timed('count_records')
+def count_records(filename=RECORDS_FILE):
+    if is_columnar(filename):
+        df = read_columnar(filename, columns=['id'])
+        return 0 if df is None else len(df)
+    index = get_index(filename)
+    return 0 if index is None else len(index.ids)
+
+
+# File wrapper that stops after a fixed number of bytes
+class _LimitedReader:
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, n=-1):
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            line = self.f.readline(self.remaining)
+            if not line:
+                return
+            self.remaining -= len(line)
+            yield line
+
+    def close(self):
+        self.f.close()
+
+
+# Stream records a chunk at a time instead of loading the whole file.
+# Yields DataFrames of up to chunksize rows holding only the latest version of each user,
+# skipping the first `offset` records and stopping after `limit` records (all if None).
+@metrics.timed('iter_records')
+def iter_records(filename=RECORDS_FILE, chunksize=10000, offset=0, limit=None):
+    import pandas as pd
+    if is_columnar(filename):
+        yield from _page_chunks(iter_columnar(filename, chunksize), None, offset, limit)
+        return
+
+    # open the file together with its index, so a compaction that swaps the file
+    # afterwards doesn't change what we're reading
+    with file_lock(filename, shared=True):
+        index = get_index(filename)
+        if index is None or not index.ids:
+            return
+        source = _LimitedReader(open(filename, 'rb'), index.stamp[0])
+    try:
+        # with no old versions in the file the first rows can be skipped without parsing them
+        latest = index.ids if index.superseded else None
+        skip = 0 if latest else offset
+        # only read as far as the index covers; rows appended while we stream are left out
+        chunks = pd.read_csv(source, chunksize=chunksize, skiprows=range(1, skip + 1),
+                             **CSV_READ_OPTIONS)
+        yield from _page_chunks(chunks, latest, offset - skip, limit)
+    finally:
+        source.close()
+
+
+# Drop old versions (rows the index doesn't point to) and apply offset / limit to a stream of chunks
+def _page_chunks(chunks, latest, offset, limit):
+    for chunk in chunks:
+        if latest is not None:
+            # keep a row only if it's the one the index points to for that user
+            current = chunk['id'].astype(str).map(lambda user_id: latest[user_id][1])
+            chunk = chunk[current.to_numpy() == chunk.index.to_numpy()]
+        if offset:
+            dropped = min(offset, len(chunk))
+            chunk = chunk.iloc[dropped:]
+            offset -= dropped
+        if limit is not None:
+            chunk = chunk.iloc[:limit]
+            limit -= len(chunk)
+        if not chunk.empty:
+            metrics.count('rows_read_total', len(chunk), operation='iter_records')
+            yield chunk
+        if limit == 0:
+            break
+
+
+# Stream the current version of every record changed since a checkpoint (change_seq > since),
+# oldest change first, as DataFrames of up to chunksize rows.
+# Rows are kept in change order, so in a CSV the first changed row is found by bisecting the
+# file and only the rows after it are read: the work grows with the number of changes, not
+# the size of the ledger. A file without a change_seq column yields every record.
+@metrics.timed('iter_changes')
+def iter_changes(since=0, filename=RECORDS_FILE, chunksize=10000):
+    import pandas as pd
+    if is_columnar(filename):
+        # columnar files are rewritten whole on every save, so there is no tail to seek to
+        df = read_columnar(filename)
+        if df is None:
+            return
+        if CHANGE_SEQ in df:
+            df = df[df[CHANGE_SEQ] > since]
+        metrics.count('rows_read_total', len(df), operation='iter_changes')
+        for i in range(0, len(df), chunksize):
+            yield df.iloc[i:i + chunksize]
+        return
+
+    # open the file together with its index, like iter_records
+    with file_lock(filename, shared=True):
+        index = get_index(filename)
+        if index is None or not index.row_count:
+            return
+        f = open(filename, 'rb')
+    try:
+        f.readline()
+        start, end = f.tell(), index.stamp[0]
+        has_seq = CHANGE_SEQ in index.columns
+        if has_seq:
+            start = _seek_change(f, index, since, start, end)
+
+        def parse(lines):
+            chunk = pd.read_csv(io.StringIO(index.header + '\n' + ''.join(lines)), **CSV_READ_OPTIONS)
+            metrics.count('rows_read_total', len(chunk), operation='iter_changes')
+            return chunk
+
+        # rows from here on are changed once one of them has change_seq > since; keep
+        # each user's latest version only (the row the index points to)
+        f.seek(start)
+        offset, changed, lines = start, not has_seq, []
+        while offset < end:
+            raw = f.readline()
+            if not raw:
+                break
+            row_offset, offset = offset, offset + len(raw)
+            line = raw.decode('utf-8')
+            if not line.strip():
+                continue
+            fields = index.parse_row(line)
+            if not changed:
+                if int(fields[CHANGE_SEQ]) <= since:
+                    continue
+                changed = True
+            if index.ids.get(fields['id'], (None,))[0] != row_offset:
+                continue
+            lines.append(line if line.endswith('\n') else line + '\n')
+            if len(lines) >= chunksize:
+                yield parse(lines)
+                lines = []
+        if lines:
+            yield parse(lines)
+    finally:
+        f.close()
+
+
+# Bytes left between the bisection and the first changed row, scanned row by row
+SEEK_BLOCK = 16384
+
+
+# Offset of a row at or shortly before the first row of a CSV with change_seq > since, found
+# by bisecting the bytes between start (first row) and end. Every row before it is older.
+def _seek_change(f, index, since, start, end):
+    low, high = start, end
+    while high - low > SEEK_BLOCK:
+        middle = (low + high) // 2
+        # the first row starting at or after middle
+        f.seek(middle - 1)
+        f.readline()
+        row_start = f.tell()
+        raw = f.readline()
+        if row_start < end and raw.strip() and int(index.parse_row(raw.decode('utf-8'))[CHANGE_SEQ]) <= since:
+            low = row_start + len(raw)
+        else:
+            high = middle
+    return low
+
+
+# Replace the whole records file with a DataFrame with the same records in it (a compaction,
+# or a migration that only changed columns), keeping the running report totals
+@metrics.timed('replace_records')
+def replace_records(df, filename=RECORDS_FILE):
+    from reporting import carry_over_running_totals
+    with file_lock(filename):
+        before = os.stat(filename) if os.path.exists(filename) else None
+        if is_columnar(filename):
+            write_columnar(df, filename)
+        else:
+            _replace_csv(df, filename)
+        if before is not None:
+            carry_over_running_totals(filename, [before.st_size, before.st_mtime_ns])
+
+
+# Fold old versions left by updates into a clean snapshot with one row per user.
+# Written to a temporary file first and swapped in, so readers never see half a file.
+@metrics.timed('compact_records')
+def compact_records(filename=RECORDS_FILE):
+    if is_columnar(filename):
+        return True   # columnar files are always written as a snapshot
+    with file_lock(filename):
+        df = read_from_csv(filename)
+        if df is None:
+            return False
+        replace_records(df, filename)
+    return True
+
+
+# Number the records of a file written before change sequences existed (1, 2, ... in file
+# order, old versions folded away) so saves can carry on from there.
+# Returns the number of records numbered (0 if the file already has the column).
+@metrics.timed('add_change_seq')
+def add_change_seq(filename=RECORDS_FILE):
+    with file_lock(filename):
+        df = read_from_csv(filename)
+        if df is None or CHANGE_SEQ in df:
+            return 0
+        df[CHANGE_SEQ] = range(1, len(df) + 1)
+        replace_records(df, filename)
+    return len(df)
+
+
+# Start loading the user index in a background thread (from its saved snapshot when that
+# is still good), so the first check_user_exists doesn't wait while the menu is up
+def warm_index(filename=RECORDS_FILE):
+    if is_columnar(filename):
+        return None
+    thread = threading.Thread(target=_warm_index, args=(filename,), daemon=True)
+    thread.start()
+    return thread
+
+
+def _warm_index(filename):
+    try:
+        get_index(filename)
+    except Exception:
+        pass   # check_user_exists reports the problem when it needs the index
+
+
+# Check a returning user's password against the credential store.
+# Users registered before the store existed (or filed through file_tax_batch) have no hash yet:
+# they get in with the usual IC rule (verify_user) and their password is hashed into the store.
+@metrics.timed('authenticate_user')
+def authenticate_user(user_id, ic_number, password, filename=RECORDS_FILE):
+    store = get_credential_store(filename)
+    if store.has(user_id):
+        ok = store.verify(user_id, password)
+    else:
+        ok = verify_user(ic_number, password)
+        if ok:
+            store.set_password(user_id, password)
+    metrics.count('logins_total', result='ok' if ok else 'failed')
+    return ok
+
+
+# Keep a new user's password (hashed) in the credential store
+@metrics.timed('register_password')
+def register_password(user_id, password, filename=RECORDS_FILE):
+    get_credential_store(filename).set_password(user_id, password)
+
+
 # Check if a user ID already exists in the CSV file.
-def check_user_exists(user_id, filename='tax_records.csv'):
-    df = read_from_csv(filename)
-
-    # checking if the file was read successfully and is not empty
-    if df is not None and not df.empty:
-        user_data = df[df['id'] == user_id] # look for the user id in the dataframe
-        if not user_data.empty:
-            # if the user exists return their IC number from the first row found
-            # using .iloc[0] to access the first matching row
-            # ensure IC number is returned as string with leading zeros preserved
-            ic_num = str(user_data.iloc[0]['ic_number']).zfill(12)
-            return (True, ic_num)
-        
+# Uses the record index, so only the user's own row is read from disk.
+@metrics.timed('check_user_exists')
+def check_user_exists(user_id, filename=RECORDS_FILE):
+    if is_columnar(filename):
+        # only load the two columns needed
+        user_data = read_columnar(filename, columns=['id', 'ic_number'], user_id=user_id)
+        if user_data is not None and not user_data.empty:
+            return (True, str(user_data.iloc[-1]['ic_number']).zfill(12))
+        return (False, None)
+
+    try:
+        with file_lock(filename, shared=True):
+            index = get_index(filename)
+            fields = index.lookup(user_id) if index is not None else None
+    except Exception as e:
+        metrics.count('operation_errors_total', operation='check_user_exists')
+        print(f"Error reading CSV: {e}")
+        fields = None
+
+    if fields is not None:
+        # ensure IC number is returned as string with leading zeros preserved
+        ic_num = str(fields['ic_number']).zfill(12)
+        return (True, ic_num)
+
     # Return if file is empty or user not found
     return (False, None)
 
 
 # Get existing tax record for a user
-def get_user_record(user_id, filename='tax_records.csv'):
-    df = read_from_csv(filename)
-    if df is not None and not df.empty:
-        user_data = df[df['id'] == user_id]
-        if not user_data.empty:
-            # Convert to dictionary and return
-            return user_data.iloc[0].to_dict()
+@metrics.timed('get_user_record')
+def get_user_record(user_id, filename=RECORDS_FILE):
+    import pandas as pd
+    if is_columnar(filename):
+        user_data = read_columnar(filename, user_id=user_id)
+        if user_data is not None and not user_data.empty:
+            return user_data.iloc[-1].to_dict()
+        return None
+
+    try:
+        with file_lock(filename, shared=True):
+            index = get_index(filename)
+            row = index.read_row(user_id) if index is not None else None
+    except Exception as e:
+        metrics.count('operation_errors_total', operation='get_user_record')
+        print(f"Error reading CSV: {e}")
+        row = None
+
+    if row is not None:
+        # Parse just the header and this one row so values get the same types as read_from_csv
+        user_data = pd.read_csv(io.StringIO(index.header + '\n' + row), **CSV_READ_OPTIONS)
+        metrics.count('rows_read_total', 1, operation='get_user_record')
+        # Convert to dictionary and return
+        return user_data.iloc[0].to_dict()
     return None
 
+
+# Non-interactive filing for a whole table of payers (e.g. read from a CSV file).
+# Every row is checked against the same limits tax_relief() enforces for the year; good rows are
+# taxed with calculate_tax_batch and saved in one write, bad rows are reported.
+# Input columns: id, ic_number, income, num_children and each relief in get_tax_rules(year).reliefs
+# (a missing relief column counts as 0).
+# Returns (saved records DataFrame, errors DataFrame with row, id and error columns).
+@metrics.timed('file_tax_batch')
+def file_tax_batch(payers, filename=RECORDS_FILE, save=True, year=DEFAULT_YEAR):
+    import numpy as np
+    import pandas as pd
+    rules = get_tax_rules(year)
+    payers = payers.reset_index(drop=True)
+    problems = pd.Series('', index=payers.index)
+
+    # add an error message to every row where mask is True
+    def flag(mask, message):
+        problems[mask] = problems[mask] + message + '; '
+
+    # a text column with blanks for missing values, or a numeric column with NaN for bad values
+    def text_column(name):
+        if name not in payers:
+            return pd.Series('', index=payers.index)
+        return payers[name].fillna('').astype(str).str.strip()
+
+    def number_column(name, default):
+        if name not in payers:
+            return pd.Series(default, index=payers.index, dtype=float)
+        return pd.to_numeric(payers[name], errors='coerce').astype(float)
+
+    # User ID: present, unique in this file and not already registered
+    ids = text_column('id')
+    flag(ids == '', "User ID cannot be empty")
+    flag(ids.duplicated(keep=False) & (ids != ''), "User ID appears more than once in the batch")
+    existing = read_from_csv(filename, columns=['id'])
+    if existing is not None:
+        flag(ids.isin(existing['id'].astype(str)), "User ID already exists")
+
+    # IC number: exactly 12 digits
+    ics = text_column('ic_number')
+    flag(~ics.str.fullmatch(r'\d{12}'), "IC number must be exactly 12 digits")
+
+    # Income: a number that isn't negative (to_numeric lets "inf" through, so check it's finite)
+    income = number_column('income', float('nan'))
+    flag(~np.isfinite(income), "Income must be a valid number")
+    flag(np.isfinite(income) & (income < 0), "Income cannot be negative")
+
+    # Each relief: between 0 and its maximum
+    records = pd.DataFrame({'id': ids, 'ic_number': ics, 'income': income})
+    for define_name, max_amount, name, _ in rules.reliefs:
+        amount = number_column(define_name, 0.0)
+        flag(~np.isfinite(amount), f"{name} must be a valid number")
+        flag(np.isfinite(amount) & ((amount < 0) | (amount > max_amount)), f"{name} must be between 0 and {max_amount}")
+        records[define_name] = amount
+
+    # Children: a whole number between 0 and get_tax_rules(year).max_children
+    children = number_column('num_children', 0.0)
+    flag(~np.isfinite(children) | (children != children.round()), "Number of children must be a whole number")
+    flag(np.isfinite(children) & ((children < 0) | (children > rules.max_children)), f"Number of children must be between 0 and {rules.max_children}")
+
+    good = problems == ''
+    records = records[good].copy()
+    records['num_children'] = children[good].astype(int)
+    records['child_relief'] = records['num_children'] * float(rules.child_relief)
+    records['total_relief'] = sum(records[column] for column in rules.relief_columns)
+    records['chargeable_income'], records['tax_payable'] = calculate_tax_batch(records['income'], records['total_relief'], year)
+    records = records[RECORD_COLUMNS].reset_index(drop=True)
+
+    errors = pd.DataFrame({'row': payers.index[~good] + 1,
+                           'id': ids[~good],
+                           'error': problems[~good].str.rstrip('; ')}).reset_index(drop=True)
+
+    if save and not records.empty:
+        if not save_many_to_csv(records, filename):
+            raise OSError(f"Could not save tax records to {filename}")
+    return records, errors
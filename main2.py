@@ -1,11 +1,19 @@
 # main.py
 # handles user registration, authentication, and tax calculation with detailed tax reliefs
 
-from functions2 import (verify_user, calculate_tax, save_to_csv, read_from_csv,
-                        check_user_exists, tax_relief, get_user_record)
+import argparse
+import sys
+
+from functions2 import (verify_user, authenticate_user, register_password, calculate_tax, save_to_csv,
+                        check_user_exists, tax_relief, get_user_record, file_tax_batch,
+                        count_records, iter_records, warm_index, RECORDS_FILE, CSV_READ_OPTIONS)
+from tax_rules import DEFAULT_YEAR
 
 # main program loop
-def main():
+# warm: load the user index in the background while the menu is shown
+def main(warm=True):
+    if warm:
+        warm_index()
     print("\n**************************************************")
     print("  WELCOME TO MALAYSIAN TAX CALCULATOR")
     print("**************************************************")
@@ -18,7 +26,7 @@ def main():
         elif choice == '2':
             login_user()
         elif choice == '3':
-            view_tax_records()
+            view_tax_records(page_size=PAGE_SIZE, interactive=True)
         elif choice == '4':
             print("\nThank you for using Malaysian Tax Calculator!")
             print("Goodbye!\n")
@@ -93,9 +101,9 @@ def login_user():
         print("Please register first.")
         return False
     
-    # if user exists, verify password
+    # if user exists, verify password against the credential store
     password = input("Enter password: ").strip()
-    if verify_user(saved_ic_number, password):
+    if authenticate_user(user_id, saved_ic_number, password):
         print(f"\nWelcome back, {user_id}!")
         # get existing record
         existing_record = get_user_record(user_id)
@@ -201,11 +209,10 @@ def calculate_and_save_tax(user_id, ic_number, password, is_new_user=True):
     print(f"Tax Payable: RM {tax_payable:,.2f}")
     print("============================================================")
     
-    # list all data to save it in CSV file
+    # list all data to save it in CSV file (same order as RECORD_COLUMNS in functions2)
     data = {
         'id': user_id,
         'ic_number': ic_number,
-        'password': password,
         'income': income,
         'individual_relief': reliefs.get('individual_relief', 0),
         'spouse_relief': reliefs.get('spouse_relief', 0),
@@ -219,8 +226,10 @@ def calculate_and_save_tax(user_id, ic_number, password, is_new_user=True):
         'chargeable_income': chargeable,
         'tax_payable': tax_payable}
     
-    # save to CSV
+    # save to CSV, and the new user's password (hashed) to the credential store
     if save_to_csv(data, update_existing=not is_new_user):
+        if is_new_user:
+            register_password(user_id, password)
         print("\nTax record saved successfully!")
     else:
         print("\nError saving tax record!")
@@ -228,35 +237,188 @@ def calculate_and_save_tax(user_id, ic_number, password, is_new_user=True):
     return True
 
 
+# records shown per page from the menu
+PAGE_SIZE = 20
+
+
+# turn a chunk of records into the printed text, numbering them from first_number
+def format_tax_records(records, first_number):
+    lines = []
+    for number, row in enumerate(records.itertuples(index=False), first_number):
+        lines.append(f"\nRecord #{number}\n"
+                     f"  User ID: {row.id}\n"
+                     f"  IC Number: {row.ic_number}\n"
+                     f"  Income: RM {row.income:,.2f}\n"
+                     f"\n  Tax Relief Breakdown:\n"
+                     f"    - Individual: RM {row.individual_relief:,.2f}\n"
+                     f"    - Spouse: RM {row.spouse_relief:,.2f}\n"
+                     f"    - Child ({int(row.num_children)} kids): RM {row.child_relief:,.2f}\n"
+                     f"    - Medical: RM {row.medical_relief:,.2f}\n"
+                     f"    - Lifestyle: RM {row.lifestyle_relief:,.2f}\n"
+                     f"    - Education: RM {row.education_relief:,.2f}\n"
+                     f"    - Parental Care: RM {row.parental_relief:,.2f}\n"
+                     f"  Total Relief: RM {row.total_relief:,.2f}\n"
+                     f"  Chargeable: RM {row.chargeable_income:,.2f}\n"
+                     f"  Tax Payable: RM {row.tax_payable:,.2f}")
+    return "\n".join(lines)
+
+
 # display all tax records from CSV file 
-def view_tax_records():
+# records are streamed in chunks, so memory use stays the same however big the file is
+# page_size: show this many records at a time (all of them if None)
+# offset: start after skipping this many records
+# interactive: ask before showing each next page
+def view_tax_records(page_size=None, offset=0, interactive=False, filename=RECORDS_FILE):
     print("\n" + "==================================================")
     print("--- TAX RECORDS ---")
     
-    df = read_from_csv()
-    if df is None or df.empty:
+    total = count_records(filename)
+    if total == 0:
         print("No tax records found. Please calculate tax first.")
         return
-    print(f"\nTotal Records: {len(df)}")
+    print(f"\nTotal Records: {total}")
     print("\n" + "=======================================================================================")
     
-    # Display records in a formatted way
-    for index, row in df.iterrows():
-        print(f"\nRecord #{index + 1}")
-        print(f"  User ID: {row['id']}")
-        print(f"  IC Number: {row['ic_number']}")
-        print(f"  Income: RM {row['income']:,.2f}")
-        print(f"\n  Tax Relief Breakdown:")
-        print(f"    - Individual: RM {row.get('individual_relief', 0):,.2f}")
-        print(f"    - Spouse: RM {row.get('spouse_relief', 0):,.2f}")
-        print(f"    - Child ({int(row.get('num_children', 0))} kids): RM {row.get('child_relief', 0):,.2f}")
-        print(f"    - Medical: RM {row.get('medical_relief', 0):,.2f}")
-        print(f"    - Lifestyle: RM {row.get('lifestyle_relief', 0):,.2f}")
-        print(f"    - Education: RM {row.get('education_relief', 0):,.2f}")
-        print(f"    - Parental Care: RM {row.get('parental_relief', 0):,.2f}")
-        print(f"  Total Relief: RM {row.get('total_relief', 0):,.2f}")
-        print(f"  Chargeable: RM {row.get('chargeable_income', 0):,.2f}")
-        print(f"  Tax Payable: RM {row['tax_payable']:,.2f}")
+    # Display records in a formatted way, a chunk at a time
+    chunksize = min(page_size or 10000, 10000)
+    while offset < total:
+        number = offset + 1
+        for chunk in iter_records(filename, chunksize, offset, page_size):
+            print(format_tax_records(chunk, number))
+            number += len(chunk)
+        if page_size is None:
+            break
+        print(f"\nShowing records {offset + 1}-{number - 1} of {total}")
+        offset += page_size
+        if not interactive or offset >= total:
+            break
+        if input("Press Enter for the next page or Q to stop: ").strip().lower() == 'q':
+            break
+
+
+# file tax for every payer in an input CSV without prompting
+# rows that fail validation are listed (and optionally written to an error file) instead
+def batch_file_tax(input_file, filename=RECORDS_FILE, errors_file=None):
+    import time
+    import pandas as pd
+
+    start = time.perf_counter()
+    payers = pd.read_csv(input_file, **CSV_READ_OPTIONS)
+    records, errors = file_tax_batch(payers, filename)
+    elapsed = time.perf_counter() - start
+
+    print(f"Filed {len(records):,} of {len(payers):,} payers in {elapsed:.2f}s "
+          f"({len(payers) / max(elapsed, 1e-9):,.0f} payers/s)")
+    if not errors.empty:
+        print(f"{len(errors):,} rows were rejected:")
+        for row in errors.head(20).itertuples(index=False):
+            print(f"  row {row.row} ({row.id or 'no ID'}): {row.error}")
+        if len(errors) > 20:
+            print(f"  ... and {len(errors) - 20:,} more")
+        if errors_file:
+            errors.to_csv(errors_file, index=False)
+            print(f"Error report written to {errors_file}")
+    return records, errors
+
+
+# print the portfolio report (total tax, payers per bracket, average relief, relief uptake)
+# full=True rescans the records instead of using the running totals
+def print_tax_report(filename=RECORDS_FILE, full=False):
+    from reporting import running_report, tax_report
+    report = tax_report(filename) if full else running_report(filename)
+
+    print("\n" + "=" * 50)
+    print(f"  TAX REPORT - ASSESSMENT YEAR {report['year']}")
+    print("=" * 50)
+    print(f"Tax payers:                {report['payers']:,}")
+    print(f"Total income:              RM {report['total_income']:,.2f}")
+    print(f"Total chargeable income:   RM {report['total_chargeable_income']:,.2f}")
+    print(f"Total tax payable:         RM {report['total_tax_payable']:,.2f}")
+    print(f"Average total relief:      RM {report['average_total_relief']:,.2f}")
+    print(f"Average tax payable:       RM {report['average_tax_payable']:,.2f}")
+    print("\nPayers per bracket:")
+    for bracket, count in report['bracket_counts'].items():
+        print(f"  Bracket {bracket}: {count:,}")
+    print("\nRelief uptake (payers claiming / total claimed):")
+    for name, count in report['relief_uptake'].items():
+        print(f"  {name:<45} {count:>8,}   RM {report['relief_totals'][name]:,.2f}")
+    return report
+
+
+# print how much more of each relief a user could claim and what it would save, plus the
+# best combination on a grid of the reliefs they still have room in
+def print_what_if(user_id, filename=RECORDS_FILE, steps=10):
+    from what_if import marginal_savings, relief_grid, what_if
+    record = get_user_record(user_id, filename)
+    if record is None:
+        print(f"No tax record for {user_id}")
+        return None
+
+    savings = marginal_savings(record)
+    print(f"\nWhat if {user_id} claimed more relief? (tax payable now RM {record['tax_payable']:,.2f})")
+    print(f"{'Relief':<45} {'Room':>10} {'Saving/RM':>10} {'Saving at cap':>14}")
+    for row in savings.itertuples():
+        print(f"{row.name:<45} {row.headroom:>10,.2f} {row.saving_per_ringgit:>10.2f} {row.saving_at_cap:>14,.2f}")
+
+    reliefs = [name for name in savings.index[savings['headroom'] > 0] if name != 'child_relief']
+    if reliefs:
+        results = what_if(record, relief_grid(record, reliefs, steps))
+        # the cheapest claim that reaches the biggest saving
+        best = results[results['saving'] == results['saving'].max()].sort_values('total_relief').iloc[0]
+        print(f"\nBest of {len(results):,} combinations: save RM {best['saving']:,.2f} with")
+        for name in reliefs:
+            if best[name] != record[name]:
+                print(f"  {name}: RM {record[name]:,.2f} -> RM {best[name]:,.2f}")
+    return savings
+
+
+# command line options; with no command the interactive menu starts
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Malaysian Tax Calculator")
+    parser.add_argument('--no-warm', action='store_true',
+                        help="don't preload the user index in the background when the menu starts")
+    commands = parser.add_subparsers(dest='command')
+
+    batch = commands.add_parser('batch', help="file tax for every payer in a CSV file")
+    batch.add_argument('input_file', help="CSV with id, ic_number, income, num_children and relief columns")
+    batch.add_argument('--records', default=RECORDS_FILE, help="tax records file to save to")
+    batch.add_argument('--errors', help="write rejected rows to this CSV file")
+
+    view = commands.add_parser('view', help="print tax records a page at a time")
+    view.add_argument('--page-size', type=int, default=None, help="records per page (default: all)")
+    view.add_argument('--offset', type=int, default=0, help="number of records to skip first")
+    view.add_argument('--records', default=RECORDS_FILE, help="tax records file to read")
+
+    recalc = commands.add_parser('recalc', help="recalculate tax for every stored record")
+    recalc.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU)")
+    recalc.add_argument('--chunk-rows', type=int, default=100000, help="records per chunk of work")
+    recalc.add_argument('--records', default=RECORDS_FILE, help="tax records file to recalculate")
+    recalc.add_argument('--year', type=int, default=DEFAULT_YEAR, help="assessment year whose rules to use")
+
+    report = commands.add_parser('report', help="print totals for the whole portfolio")
+    report.add_argument('--full', action='store_true', help="rescan every record instead of using the running totals")
+    report.add_argument('--records', default=RECORDS_FILE, help="tax records file to report on")
+
+    whatif = commands.add_parser('whatif', help="how much a user would save by claiming more relief")
+    whatif.add_argument('--id', required=True, help="user ID")
+    whatif.add_argument('--steps', type=int, default=10, help="grid steps per relief for the best combination")
+    whatif.add_argument('--records', default=RECORDS_FILE, help="tax records file to read")
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    if args.command == 'batch':
+        batch_file_tax(args.input_file, args.records, args.errors)
+    elif args.command == 'view':
+        view_tax_records(args.page_size, args.offset, filename=args.records)
+    elif args.command == 'recalc':
+        from recalculate import recalculate_records
+        rows, seconds = recalculate_records(args.records, args.workers, args.chunk_rows, year=args.year)
+        print(f"Recalculated {rows:,} records in {seconds:.2f}s ({rows / max(seconds, 1e-9):,.0f} records/s)")
+    elif args.command == 'report':
+        print_tax_report(args.records, args.full)
+    elif args.command == 'whatif':
+        print_what_if(args.id, args.records, args.steps)
+    else:
+        main(warm=not args.no_warm)
\ No newline at end of file
@@ -0,0 +1,267 @@
+# metrics.py
+# Counters and latency histograms for the storage and calculation code, so a slow login or a
+# busy lock shows up somewhere. Off by default; while off every hook returns straight away.
+# Turn it on with enable() or the TAX_METRICS environment variable, e.g.
+#   TAX_METRICS=prometheus:/var/lib/node_exporter/tax.prom   (Prometheus text file)
+#   TAX_METRICS=log:tax_metrics.log                          (one JSON snapshot per line)
+#   TAX_METRICS=snapshot                                      (in process only, see snapshot())
+# Several sinks can be given separated by commas. File sinks are written every
+# TAX_METRICS_INTERVAL seconds (default 10) and when the program exits.
+
+import atexit
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is everything above
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds for histograms of sizes (rows per commit and so on)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000, 1000000)
+
+PREFIX = 'tax_'
+
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}       # (name, labels) -> value
+_histograms = {}     # (name, labels) -> [bucket counts..., count, sum]
+_bounds = {}         # histogram name -> bucket bounds
+_help = {}           # metric name -> description
+_sinks = []
+_flusher = None
+
+
+# Describe a metric (shows up as # HELP in the Prometheus file)
+def describe(name, text):
+    _help[PREFIX + name] = text
+
+
+# Add to a counter, e.g. count('rows_read', 10, operation='read_from_csv')
+def count(name, amount=1, **labels):
+    if not enabled:
+        return
+    key = (PREFIX + name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+# Record one observation in a histogram (latencies in seconds by default)
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    if not enabled:
+        return
+    name = PREFIX + name
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        bounds = _bounds.setdefault(name, buckets)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(bounds) + 1) + [0, 0.0]
+        histogram[bisect_left(bounds, value)] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+
+# Decorator: time every call into the operation_seconds histogram and count the ones that raise.
+# Generator functions are timed until they are used up.
+def timed(operation):
+    def decorate(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if not enabled:
+                    return func(*args, **kwargs)
+                return _timed_generator(operation, func(*args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                count('operation_errors_total', operation=operation)
+                raise
+            finally:
+                observe('operation_seconds', time.perf_counter() - start, operation=operation)
+        return wrapper
+    return decorate
+
+
+def _timed_generator(operation, generator):
+    start = time.perf_counter()
+    try:
+        yield from generator
+    except BaseException:
+        count('operation_errors_total', operation=operation)
+        raise
+    finally:
+        observe('operation_seconds', time.perf_counter() - start, operation=operation)
+
+
+# All metrics as plain data:
+# {'counters': {'name{label="value"}': number}, 'histograms': {'name{...}': {'count', 'sum', 'buckets'}}}
+# where buckets is a list of [upper bound, cumulative count] like Prometheus.
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+    result = {'time': time.time(), 'counters': {}, 'histograms': {}}
+    for (name, labels), value in sorted(counters.items()):
+        result['counters'][_series(name, labels)] = value
+    for (name, labels), values in sorted(histograms.items()):
+        bounds = _bounds[name]
+        cumulative, buckets = 0, []
+        for bound, bucket_count in zip(list(bounds) + ['+Inf'], values):
+            cumulative += bucket_count
+            buckets.append([bound, cumulative])
+        result['histograms'][_series(name, labels)] = {'count': values[-2], 'sum': values[-1], 'buckets': buckets}
+    return result
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# Prometheus text exposition format for the current metrics
+def prometheus_text():
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(value) for key, value in _histograms.items()}
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            if name in _help:
+                lines.append(f'# HELP {name} {_help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, 'counter')
+        lines.append(f'{_series(name, labels)} {value}')
+    for (name, labels), values in sorted(histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, bucket_count in zip(list(_bounds[name]) + ['+Inf'], values):
+            cumulative += bucket_count
+            lines.append(f'{_series(name + "_bucket", labels + (("le", bound),))} {cumulative}')
+        lines.append(f'{_series(name + "_sum", labels)} {values[-1]}')
+        lines.append(f'{_series(name + "_count", labels)} {values[-2]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Sinks: anything with a write() method, called with no arguments when metrics are flushed
+
+# Keeps the last snapshot in memory (snapshot() works without any sink too)
+class SnapshotSink:
+
+    def __init__(self):
+        self.last = None
+
+    def write(self):
+        self.last = snapshot()
+
+
+# Appends one JSON snapshot per line to a log file
+class LogSink:
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(snapshot()) + '\n')
+
+
+# Rewrites a Prometheus text file (for node_exporter's textfile collector); written to a
+# temporary file and swapped in so the collector never reads half a file
+class PrometheusFileSink:
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self):
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(prometheus_text())
+        os.replace(self.path + '.tmp', self.path)
+
+
+# Write the metrics to every sink now
+def flush():
+    for sink in list(_sinks):
+        try:
+            sink.write()
+        except OSError:
+            pass   # metrics must never break the program
+
+
+def _flush_every(interval):
+    while True:
+        time.sleep(interval)
+        flush()
+
+
+# Start collecting. Sinks are written every `interval` seconds (if any are given) and at exit.
+def enable(*sinks, interval=10.0):
+    global enabled, _flusher
+    _sinks.extend(sinks)
+    enabled = True
+    if sinks and interval and _flusher is None:
+        _flusher = threading.Thread(target=_flush_every, args=(interval,), daemon=True)
+        _flusher.start()
+
+
+# Stop collecting (what was collected is kept until reset())
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+# Sinks from a TAX_METRICS style string, e.g. 'prometheus:tax.prom,log:tax.log'
+def sinks_from_spec(spec):
+    sinks = []
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        kind, _, path = part.partition(':')
+        if kind == 'snapshot':
+            sinks.append(SnapshotSink())
+        elif kind == 'log' and path:
+            sinks.append(LogSink(path))
+        elif kind == 'prometheus' and path:
+            sinks.append(PrometheusFileSink(path))
+        else:
+            raise ValueError(f"Unknown metrics sink '{part}' (use snapshot, log:PATH or prometheus:PATH)")
+    return sinks
+
+
+describe('operation_seconds', "Time spent in each storage / calculation operation")
+describe('operation_errors_total', "Operations that failed")
+describe('rows_read_total', "Records read from the records file")
+describe('rows_written_total', "Records written to the records file")
+describe('bytes_written_total', "Bytes written to the records file")
+describe('lock_wait_seconds', "Time spent waiting for a records file lock")
+describe('cache_hits_total', "Lookups answered from a cache")
+describe('cache_misses_total', "Lookups a cache could not answer")
+describe('commit_writes', "Writes committed together by one group commit")
+describe('logins_total', "Login attempts by result")
+
+atexit.register(flush)
+
+if os.environ.get('TAX_METRICS'):
+    enable(*sinks_from_spec(os.environ['TAX_METRICS']),
+           interval=float(os.environ.get('TAX_METRICS_INTERVAL', 10)))
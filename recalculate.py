@@ -0,0 +1,135 @@
+# recalculate.py
+# Recompute chargeable_income and tax_payable for every stored record, e.g. after the
+# brackets in calculate_tax change for a new assessment year.
+# The file is split into chunks that are parsed, taxed and formatted in separate
+# processes; the results are written to a temporary file in order and swapped in at the end.
+# Every record counts as changed: its change_seq is moved past the current highest one
+# (keeping the order), so delta exports pick the new figures up.
+
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from functions2 import (CHANGE_SEQ, CSV_READ_OPTIONS, RECORDS_FILE, calculate_tax_batch, compact_records,
+                        format_csv_rows)
+from file_lock import file_lock
+from record_index import get_index, invalidate_index
+from storage_backends import is_columnar, read_columnar, write_columnar
+from tax_rules import DEFAULT_YEAR, get_tax_rules
+
+
+# Recalculate the tax columns of a DataFrame of records with the given year's rules,
+# adding seq_shift to their change_seq
+def recalculate_frame(records, seq_shift=0, year=DEFAULT_YEAR):
+    records = records.copy()
+    records['chargeable_income'], records['tax_payable'] = calculate_tax_batch(
+        records['income'], records['total_relief'], year)
+    if seq_shift and CHANGE_SEQ in records:
+        records[CHANGE_SEQ] += seq_shift
+    return records
+
+
+# How far to move change sequences from first..last so they all come after last, in the same order
+def _seq_shift(first, last):
+    return last - first + 1
+
+
+# Worker: parse one byte range of the CSV, recalculate it and return it as CSV text
+def _recalculate_csv_range(filename, header, start, end, seq_shift=0, year=DEFAULT_YEAR):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # IDs stay text too, or a chunk of numeric IDs like '001' would be written back as 1
+    records = pd.read_csv(io.BytesIO(header + b'\n' + data), **CSV_READ_OPTIONS)
+    return len(records), format_csv_rows(recalculate_frame(records, seq_shift, year)).encode('utf-8')
+
+
+# Split a CSV into byte ranges of roughly chunk_bytes, each ending on a line break
+def _csv_ranges(filename, chunk_bytes):
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return header.rstrip(b'\r\n'), ranges
+
+
+# Recalculate every record in the file using `workers` processes (default: one per CPU).
+# chunk_rows is the rough number of records handed to a worker at a time.
+# year: assessment year whose brackets are used (see tax_rules.json).
+# The file stays locked while this runs so no saves are lost.
+# Returns (number of records, seconds taken).
+def recalculate_records(filename=RECORDS_FILE, workers=None, chunk_rows=100000, progress=True, year=DEFAULT_YEAR):
+    get_tax_rules(year)   # unknown years fail here, not in every worker
+    with file_lock(filename):
+        return _recalculate_locked(filename, workers or os.cpu_count() or 1, chunk_rows, progress, year)
+
+
+def _recalculate_locked(filename, workers, chunk_rows, progress, year):
+    start_time = time.perf_counter()
+
+    if is_columnar(filename):
+        records = read_columnar(filename)
+        if records is None:
+            return 0, 0.0
+        chunks = [records.iloc[i:i + chunk_rows] for i in range(0, len(records), chunk_rows)]
+        seq_shift = 0
+        if CHANGE_SEQ in records and len(records):
+            seq_shift = _seq_shift(int(records[CHANGE_SEQ].min()), int(records[CHANGE_SEQ].max()))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(recalculate_frame, chunks, [seq_shift] * len(chunks), [year] * len(chunks)))
+        if results:
+            write_columnar(pd.concat(results, ignore_index=True), filename)
+        return len(records), time.perf_counter() - start_time
+
+    index = get_index(filename)
+    if index is None or not index.ids:
+        return 0, 0.0
+    # fold old versions away first so every row in the file is a current record
+    if index.superseded:
+        compact_records(filename)
+        index = get_index(filename)
+
+    seq_shift = 0
+    if CHANGE_SEQ in index.columns:
+        seq_shift = _seq_shift(int(index.parse_row(index.first_row())[CHANGE_SEQ]),
+                               int(index.parse_row(index.last_row())[CHANGE_SEQ]))
+
+    # aim for chunk_rows records per range, based on the average row length
+    average_row = max(1, os.path.getsize(filename) // max(1, index.row_count))
+    header, ranges = _csv_ranges(filename, chunk_rows * average_row)
+
+    temp_name = filename + '.tmp'
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(temp_name, 'wb') as out:
+        out.write(header + b'\n')
+        pending = deque()
+        next_range = 0
+        # keep a few chunks per worker in flight so memory stays bounded
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < workers * 2:
+                start, end = ranges[next_range]
+                pending.append(pool.submit(_recalculate_csv_range, filename, header, start, end, seq_shift, year))
+                next_range += 1
+            rows, data = pending.popleft().result()
+            out.write(data)
+            done += rows
+            if progress:
+                elapsed = time.perf_counter() - start_time
+                print(f"  {done:,} / {index.row_count:,} records ({done / max(elapsed, 1e-9):,.0f} records/s)")
+        # on disk before it replaces the records, like functions2._replace_csv
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temp_name, filename)
+    invalidate_index(filename)
+    return done, time.perf_counter() - start_time
@@ -0,0 +1,287 @@
+# record_index.py
+# Lookup index for tax_records.csv so one user can be found without parsing the whole file.
+# The index maps each user ID to the byte offset of its latest row, is saved next to the CSV
+# (tax_records.csv.idx) and is only rebuilt when the CSV's size or modification time changes.
+# If rows were only appended since it was saved, just the new rows are read.
+
+import atexit
+import csv
+import json
+import os
+
+import metrics
+from file_lock import file_lock
+
+INDEX_SUFFIX = '.idx'
+# Bytes from the end of the indexed part of the CSV kept with the saved index, to check that
+# a file which has grown since still starts with what was indexed
+TAIL_BYTES = 64
+
+# Indexes already loaded in this process, keyed by CSV filename
+_indexes = {}
+
+
+# Split one CSV line into its fields (only use the csv module when quotes are involved)
+def _split_line(line):
+    line = line.rstrip('\r\n')
+    if '"' in line:
+        return next(csv.reader([line]))
+    return line.split(',')
+
+
+# Return (size, mtime) of a file or None if it doesn't exist
+def _file_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class RecordIndex:
+
+    def __init__(self, filename, with_ic=False):
+        self.filename = filename
+        self.stamp = None
+        self.header = None          # raw header line of the CSV
+        self.columns = []
+        self.ids = {}               # user ID -> [byte offset, row number]
+        self.ics = {} if with_ic else None   # IC number -> user ID (optional)
+        self.row_count = 0          # rows in the file, including old versions
+        self.superseded = 0         # old versions left behind by updates
+        self.ends_with_newline = True
+        self.dirty = False          # changed since it was last saved
+
+    # Scan the CSV once, line by line, recording where every user's row starts
+    def build(self):
+        self.stamp = _file_stamp(self.filename)
+        self.header = None
+        self.columns = []
+        self.ids = {}
+        if self.ics is not None:
+            self.ics = {}
+        self.row_count = 0
+        self.superseded = 0
+        self.ends_with_newline = True
+        with open(self.filename, 'rb') as f:
+            offset = 0
+            for raw in f:
+                self._add_line(raw, offset)
+                offset += len(raw)
+        self.dirty = True
+        return self
+
+    # Record a single raw line that starts at the given byte offset
+    def _add_line(self, raw, offset):
+        self.ends_with_newline = raw.endswith(b'\n')
+        self._add_text(raw.decode('utf-8'), offset)
+
+    # Record one decoded line (only the id and ic_number fields are split out)
+    def _add_text(self, line, offset):
+        if not line.strip():
+            return
+        if self.header is None:
+            self.header = line.rstrip('\r\n')
+            self.columns = _split_line(line)
+            return
+        id_column = self.columns.index('id') if 'id' in self.columns else 0
+        ic_column = self.columns.index('ic_number') if self.ics is not None and 'ic_number' in self.columns else None
+        if '"' in line:
+            fields = _split_line(line)
+        else:
+            fields = line.rstrip('\r\n').split(',', max(id_column, ic_column or 0) + 1)
+        user_id = fields[id_column]
+        # updates are appended, so the last row for an ID is its current version
+        if user_id in self.ids:
+            self.superseded += 1
+        self.ids[user_id] = [offset, self.row_count]
+        if ic_column is not None:
+            self.ics[fields[ic_column]] = user_id
+        self.row_count += 1
+
+    # Add rows that were just appended to the CSV (data is the exact bytes written at offset)
+    def note_append(self, offset, data):
+        text = data.decode('utf-8')
+        if text.isascii():
+            # one character per byte, so offsets can be counted on the decoded text
+            for line in text.splitlines(keepends=True):
+                self._add_text(line, offset)
+                offset += len(line)
+            self.ends_with_newline = text.endswith('\n')
+        else:
+            for raw in data.splitlines(keepends=True):
+                self._add_line(raw, offset)
+                offset += len(raw)
+        self.stamp = _file_stamp(self.filename)
+        self.dirty = True
+
+    # The CSV changed since this index was saved: if rows were only appended (same file,
+    # the bytes the index ends on are still there) index just those rows instead of rescanning.
+    # tail and inode come from the saved index. Returns False if the file needs a full scan.
+    # The caller holds a shared lock, so no append is half written.
+    def catch_up(self, tail, inode):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return False
+        size = self.stamp[0]
+        if (tail is None or stat.st_ino != inode or stat.st_size < size
+                or not self.ends_with_newline or len(tail) != min(size, TAIL_BYTES)):
+            return False
+        with open(self.filename, 'rb') as f:
+            f.seek(size - len(tail))
+            if f.read(len(tail)) != tail:
+                return False
+            data = f.read(stat.st_size - size)
+        self.note_append(size, data)
+        return True
+
+    # True if the CSV hasn't changed since this index was built
+    def is_current(self):
+        return self.stamp is not None and self.stamp == _file_stamp(self.filename)
+
+    # Read the raw row for a user straight from its offset (None if not found)
+    def read_row(self, user_id):
+        entry = self.ids.get(str(user_id))
+        if entry is None:
+            return None
+        with open(self.filename, 'rb') as f:
+            f.seek(entry[0])
+            return f.readline().decode('utf-8').rstrip('\r\n')
+
+    # Look up a user and return their row as a {column: text} dictionary
+    def lookup(self, user_id):
+        row = self.read_row(user_id)
+        if row is None:
+            return None
+        return self.parse_row(row)
+
+    # Split a raw row into a {column: text} dictionary
+    def parse_row(self, row):
+        return dict(zip(self.columns, _split_line(row)))
+
+    # Raw text of the first row after the header (None if there are no rows)
+    def first_row(self):
+        if not self.row_count:
+            return None
+        with open(self.filename, 'rb') as f:
+            f.readline()
+            for raw in f:
+                if raw.strip():
+                    return raw.decode('utf-8').rstrip('\r\n')
+        return None
+
+    # Raw text of the last row in the indexed part of the CSV (None if there are no rows),
+    # read backwards from the end so the rest of the file is never touched
+    def last_row(self):
+        if not self.row_count:
+            return None
+        end = self.stamp[0]
+        size = 1024
+        with open(self.filename, 'rb') as f:
+            while True:
+                start = max(0, end - size)
+                f.seek(start)
+                data = f.read(end - start).rstrip(b'\r\n')
+                if b'\n' in data or start == 0:
+                    return data.rsplit(b'\n', 1)[-1].decode('utf-8').rstrip('\r')
+                size *= 4
+
+    # Find which user ID an IC number belongs to
+    def id_for_ic(self, ic_number):
+        if self.ics is None:
+            return None
+        return self.ics.get(str(ic_number))
+
+    # Write the index next to the CSV (temp file + replace so a crash can't leave half an index)
+    def save(self):
+        path = self.filename + INDEX_SUFFIX
+        state = {'stamp': self.stamp, 'header': self.header, 'ids': self.ids, 'ics': self.ics,
+                 'row_count': self.row_count, 'superseded': self.superseded,
+                 'ends_with_newline': self.ends_with_newline}
+        try:
+            # remember where the indexed part ends so a later load can catch up on appends
+            with open(self.filename, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if [stat.st_size, stat.st_mtime_ns] != self.stamp:
+                    return  # the CSV changed (or was replaced) since it was indexed
+                state['inode'] = stat.st_ino
+                f.seek(max(0, self.stamp[0] - TAIL_BYTES))
+                state['tail'] = f.read(min(self.stamp[0], TAIL_BYTES)).hex()
+            with open(path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(path + '.tmp', path)
+            self.dirty = False
+        except OSError:
+            pass  # the index is only a cache, the CSV is still the source of truth
+
+    # Load a saved index if it still matches the CSV on disk, else return None
+    @classmethod
+    def load(cls, filename, with_ic=False):
+        try:
+            with open(filename + INDEX_SUFFIX) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if with_ic and state.get('ics') is None:
+            return None
+        if state.get('stamp') is None:
+            return None
+        index = cls(filename)
+        index.stamp = state['stamp']
+        index.header = state['header']
+        index.columns = _split_line(state['header']) if state['header'] else []
+        index.ids = state['ids']
+        index.ics = state['ics']
+        index.row_count = state['row_count']
+        index.superseded = state.get('superseded', 0)
+        index.ends_with_newline = state['ends_with_newline']
+        if not index.is_current():
+            tail = bytes.fromhex(state['tail']) if state.get('tail') is not None else None
+            if not index.catch_up(tail, state.get('inode')):
+                return None
+        return index
+
+
+# Get an up to date index for a CSV file (None if the file doesn't exist).
+# Uses the copy in memory, then the saved .idx file, and only rescans the CSV as a last resort.
+def get_index(filename='tax_records.csv', with_ic=False):
+    index = _indexes.get(filename)
+    if index is not None and index.is_current() and (index.ics is not None or not with_ic):
+        metrics.count('cache_hits_total', cache='record_index')
+        return index
+    metrics.count('cache_misses_total', cache='record_index')
+    if _file_stamp(filename) is None:
+        _indexes.pop(filename, None)
+        return None
+
+    # a shared lock so a half-finished append isn't indexed
+    with file_lock(filename, shared=True):
+        index = RecordIndex.load(filename, with_ic)
+        if index is None:
+            metrics.count('cache_misses_total', cache='index_snapshot')
+            index = RecordIndex(filename, with_ic).build()
+            index.save()
+        else:
+            metrics.count('cache_hits_total', cache='index_snapshot')
+    _indexes[filename] = index
+    return index
+
+
+# Forget the index for a file (after it was rewritten)
+def invalidate_index(filename='tax_records.csv'):
+    _indexes.pop(filename, None)
+
+
+# Save indexes that were updated in memory by appends
+# (under a shared lock, so another process can't append while the tail is read)
+@atexit.register
+def save_indexes():
+    for filename, index in list(_indexes.items()):
+        if index.dirty and index.is_current():
+            try:
+                with file_lock(filename, shared=True):
+                    if index.is_current():
+                        index.save()
+            except OSError:
+                pass  # the index is only a cache
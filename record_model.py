@@ -0,0 +1,170 @@
+# record_model.py
+# Compact in-memory form of the tax ledger.
+# A DataFrame from read_from_csv keeps id / ic_number as Python strings (50+ bytes each) and
+# every number as float64 or int64. TaxLedger packs the same record columns into one
+# structured numpy array instead:
+#   - id is a code into a sorted table of fixed-width ids (the table doubles as the lookup index)
+#   - ic_number is 12 bytes
+#   - the single relief amounts are float32 (they are capped well inside float32's exact
+#     cents range), num_children is int8
+#   - income, total relief, chargeable income and tax payable stay float64 so large
+#     amounts keep their cents
+# Usage: ledger = TaxLedger.load('tax_records.csv'); ledger.get('Ali_Ahmad')['tax_payable']
+
+import numpy as np
+
+from functions2 import RECORD_COLUMNS, RECORDS_FILE, iter_records
+
+RECORD_DTYPE = np.dtype([
+    ('id_code', np.int32),
+    ('ic_number', 'S12'),
+    ('income', np.float64),
+    ('individual_relief', np.float32),
+    ('spouse_relief', np.float32),
+    ('child_relief', np.float32),
+    ('num_children', np.int8),
+    ('medical_relief', np.float32),
+    ('lifestyle_relief', np.float32),
+    ('education_relief', np.float32),
+    ('parental_relief', np.float32),
+    ('total_relief', np.float64),
+    ('chargeable_income', np.float64),
+    ('tax_payable', np.float64),
+])
+
+FLOAT32_COLUMNS = [name for name in RECORD_DTYPE.names if RECORD_DTYPE[name] == np.float32]
+TEXT_COLUMNS = ['ic_number']
+
+# float32 keeps 2 decimal places exactly (after rounding back) for amounts below 2**17
+FLOAT32_LIMIT = 2.0 ** 17
+
+
+# One payer's record, read from a TaxLedger. Works like the dict get_user_record returns.
+class TaxRecord:
+    __slots__ = RECORD_COLUMNS
+
+    def __init__(self, user_id, row):
+        self.id = user_id
+        for name in RECORD_DTYPE.names[1:]:
+            value = row[name]
+            if name in TEXT_COLUMNS:
+                value = value.decode('ascii')
+            elif name == 'num_children':
+                value = int(value)
+            elif name in FLOAT32_COLUMNS:
+                value = round(float(value), 2)
+            else:
+                value = float(value)
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in RECORD_COLUMNS}
+
+    def __repr__(self):
+        return f"TaxRecord({self.to_dict()!r})"
+
+
+class TaxLedger:
+    __slots__ = ('ids', 'rows_by_code', 'records')
+
+    def __init__(self, ids, records):
+        # ids: sorted, unique fixed-width bytes; records: RECORD_DTYPE array in file order
+        self.ids = ids
+        self.records = records
+        self.rows_by_code = np.empty(len(ids), dtype=np.int32)
+        self.rows_by_code[records['id_code']] = np.arange(len(records), dtype=np.int32)
+
+    # Pack a DataFrame with the record columns (one row per user)
+    @classmethod
+    def from_frame(cls, df):
+        ids, records = _pack(df)
+        ids, codes = np.unique(ids, return_inverse=True)
+        if len(ids) != len(records):
+            raise ValueError("Ledger has more than one row for some user IDs")
+        records['id_code'] = codes
+        return cls(ids, records)
+
+    # Load the current record of every user, a chunk at a time so the full
+    # DataFrame is never held in memory
+    @classmethod
+    def load(cls, filename=RECORDS_FILE, chunksize=100000):
+        id_parts, record_parts = [], []
+        for chunk in iter_records(filename, chunksize=chunksize):
+            ids, records = _pack(chunk)
+            id_parts.append(ids)
+            record_parts.append(records)
+        if not record_parts:
+            return cls(np.array([], dtype='S1'), np.zeros(0, dtype=RECORD_DTYPE))
+        ids, codes = np.unique(np.concatenate(id_parts), return_inverse=True)
+        records = np.concatenate(record_parts)
+        if len(ids) != len(records):
+            raise ValueError("Ledger has more than one row for some user IDs")
+        records['id_code'] = codes
+        return cls(ids, records)
+
+    def __len__(self):
+        return len(self.records)
+
+    # Row number of a user, or None
+    def find(self, user_id):
+        key = str(user_id).encode('utf-8')
+        code = int(np.searchsorted(self.ids, key))
+        if code < len(self.ids) and self.ids[code] == key:
+            return int(self.rows_by_code[code])
+        return None
+
+    def __contains__(self, user_id):
+        return self.find(user_id) is not None
+
+    # A user's record as a TaxRecord, or None if they have none
+    def get(self, user_id):
+        row = self.find(user_id)
+        if row is None:
+            return None
+        return TaxRecord(str(user_id), self.records[row])
+
+    # One column for every record, in file order (amounts as float64)
+    def column(self, name):
+        if name == 'id':
+            return np.char.decode(self.ids[self.records['id_code']], 'utf-8')
+        values = self.records[name]
+        if name in TEXT_COLUMNS:
+            return np.char.decode(values, 'ascii')
+        if name in FLOAT32_COLUMNS:
+            return values.astype(np.float64).round(2)
+        return values
+
+    # Back to a DataFrame like read_from_csv returns
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame({name: self.column(name) for name in RECORD_COLUMNS})
+
+    # Bytes held by the ledger
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.rows_by_code.nbytes + self.records.nbytes
+
+
+# Turn a DataFrame of records into (encoded ids, RECORD_DTYPE array without id codes)
+def _pack(df):
+    ids = df['id'].astype(str).str.encode('utf-8').to_numpy(dtype=bytes)
+    records = np.zeros(len(df), dtype=RECORD_DTYPE)
+    ic_numbers = df['ic_number'].astype(str)
+    if (ic_numbers.str.len() > 12).any():
+        raise ValueError("IC numbers must be at most 12 characters")
+    records['ic_number'] = ic_numbers.str.encode('ascii').to_numpy(dtype=bytes)
+
+    for name in RECORD_DTYPE.names[2:]:
+        values = df[name].to_numpy(dtype=np.float64)
+        if name in FLOAT32_COLUMNS and (np.abs(values) >= FLOAT32_LIMIT).any():
+            raise ValueError(f"{name} is too large for the compact ledger")
+        if name == 'num_children' and ((values < 0) | (values > 127)).any():
+            raise ValueError("num_children is out of range")
+        records[name] = values
+    return ids, records
@@ -0,0 +1,151 @@
+# reporting.py
+# Portfolio figures over the tax records: total tax collected, payers in each bracket,
+# average relief and how many payers claim each relief.
+# tax_report() works them out from the file a chunk at a time. running_report() answers
+# from running totals kept next to the file (tax_records.csv.agg.json), which every
+# save_to_csv keeps up to date, so it doesn't have to rescan the records.
+
+import json
+import os
+
+import numpy as np
+
+from file_lock import file_lock
+from functions2 import RECORDS_FILE, iter_records
+from tax_rules import DEFAULT_YEAR, get_tax_rules
+
+AGGREGATES_SUFFIX = '.agg.json'
+
+
+def _file_stamp(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Totals that start at zero, for the given year's brackets and reliefs
+def _empty_totals(year):
+    rules = get_tax_rules(year)
+    return {'year': year, 'payers': 0, 'income': 0.0, 'total_relief': 0.0,
+            'chargeable_income': 0.0, 'tax_payable': 0.0,
+            'brackets': [0] * len(rules.brackets),
+            'relief_claims': {define_name: 0 for define_name, _, _, _ in rules.reliefs} | {'child_relief': 0},
+            'relief_amounts': {define_name: 0.0 for define_name, _, _, _ in rules.reliefs} | {'child_relief': 0.0}}
+
+
+# Totals for a DataFrame of records (all vectorized), added to `totals` times sign (+1 or -1)
+def _add_frame(totals, records, sign=1):
+    if records is None or records.empty:
+        return totals
+    rules = get_tax_rules(totals['year'])
+    totals['payers'] += sign * len(records)
+    for column in ('income', 'total_relief', 'chargeable_income', 'tax_payable'):
+        totals[column] += sign * float(records[column].sum())
+
+    # Bracket of each payer's chargeable income (Bracket A covers everything up to the first limit)
+    chargeable = records['chargeable_income'].to_numpy(dtype=np.float64)
+    bracket = np.clip(np.searchsorted(rules.lowers_array, chargeable, side='left') - 1, 0, len(rules.lowers) - 1)
+    counts = np.bincount(bracket, minlength=len(rules.lowers))
+    totals['brackets'] = [int(total + sign * count) for total, count in zip(totals['brackets'], counts)]
+
+    # A relief counts as claimed when its amount is above zero, like the claimed_reliefs set in tax_relief()
+    for define_name in totals['relief_claims']:
+        if define_name in records:
+            amounts = records[define_name].astype(float)
+            totals['relief_claims'][define_name] += sign * int((amounts > 0).sum())
+            totals['relief_amounts'][define_name] += sign * float(amounts.sum())
+    return totals
+
+
+# Turn running totals into the report
+def _summary(totals):
+    rules = get_tax_rules(totals['year'])
+    names = {define_name: name for define_name, _, name, _ in rules.reliefs} | {'child_relief': 'Child Relief'}
+    payers = totals['payers']
+    bracket_names = [chr(ord('A') + k) for k in range(len(rules.brackets))]
+    return {
+        'year': totals['year'],
+        'payers': payers,
+        'total_tax_payable': round(totals['tax_payable'], 2),
+        'total_income': round(totals['income'], 2),
+        'total_chargeable_income': round(totals['chargeable_income'], 2),
+        'average_total_relief': round(totals['total_relief'] / payers, 2) if payers else 0.0,
+        'average_tax_payable': round(totals['tax_payable'] / payers, 2) if payers else 0.0,
+        'bracket_counts': dict(zip(bracket_names, totals['brackets'])),
+        'relief_uptake': {names[define_name]: count for define_name, count in totals['relief_claims'].items()},
+        'relief_totals': {names[define_name]: round(amount, 2)
+                          for define_name, amount in totals['relief_amounts'].items()}}
+
+
+# Work out the totals by reading every record (a chunk at a time, so memory stays flat)
+def _scan_totals(filename, year):
+    totals = _empty_totals(year)
+    for chunk in iter_records(filename, chunksize=100000):
+        _add_frame(totals, chunk)
+    return totals
+
+
+# Full report straight from the records
+def tax_report(filename=RECORDS_FILE, year=DEFAULT_YEAR):
+    return _summary(_scan_totals(filename, year))
+
+
+def _load_totals(filename):
+    try:
+        with open(filename + AGGREGATES_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_totals(filename, totals):
+    path = filename + AGGREGATES_SUFFIX
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(totals, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass   # only a cache; the next report rescans
+
+
+# Report from the running totals; they are rebuilt from the records only when they are
+# missing or don't match the file (e.g. it was edited outside save_to_csv)
+def running_report(filename=RECORDS_FILE, year=DEFAULT_YEAR):
+    with file_lock(filename, shared=True):
+        totals = _load_totals(filename)
+        stamp = _file_stamp(filename)
+        if totals is None or totals.get('stamp') != stamp or totals.get('year') != year:
+            totals = _scan_totals(filename, year)
+            totals['stamp'] = stamp
+            _save_totals(filename, totals)
+    return _summary(totals)
+
+
+# True if the running totals match the file as it was at `stamp`
+def running_totals_current(filename, stamp):
+    totals = _load_totals(filename)
+    return totals is not None and totals.get('stamp') == stamp
+
+
+# Called by save_to_csv while it holds the file lock, after new rows were written.
+# added: the records as they are now; replaced: the previous versions of those users.
+# before: the file's stamp before the write. Totals that were already out of date are left
+# alone (running_report rebuilds them).
+def update_running_totals(filename, before, added, replaced):
+    totals = _load_totals(filename)
+    if totals is None or totals.get('stamp') != before:
+        return
+    _add_frame(totals, replaced, -1)
+    _add_frame(totals, added, +1)
+    totals['stamp'] = _file_stamp(filename)
+    _save_totals(filename, totals)
+
+
+# The file was rewritten without changing any record (e.g. compaction): keep the totals valid
+def carry_over_running_totals(filename, before):
+    totals = _load_totals(filename)
+    if totals is not None and totals.get('stamp') == before:
+        totals['stamp'] = _file_stamp(filename)
+        _save_totals(filename, totals)
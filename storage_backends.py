@@ -0,0 +1,103 @@
+# storage_backends.py
+# Typed columnar storage for the tax records (Parquet or Feather, needs pyarrow).
+# The format is picked from the file extension, so functions2 works the same with
+# 'tax_records.csv', 'tax_records.parquet' or 'tax_records.feather'.
+
+import os
+
+
+# Parquet can skip row groups that don't contain the user, so pass the ID as a filter
+def _read_parquet(filename, columns=None, user_id=None):
+    import pandas as pd
+    filters = [('id', '==', user_id)] if user_id is not None else None
+    return pd.read_parquet(filename, columns=columns, filters=filters)
+
+
+def _write_parquet(df, filename):
+    df.to_parquet(filename, index=False)
+
+
+def _read_feather(filename, columns=None, user_id=None):
+    import pandas as pd
+    df = pd.read_feather(filename, columns=columns)
+    if user_id is not None:
+        df = df[df['id'] == user_id]
+    return df
+
+
+def _write_feather(df, filename):
+    df.reset_index(drop=True).to_feather(filename)
+
+
+# Registered formats: file extension -> (reader, writer)
+# A reader takes (filename, columns=None, user_id=None) and returns a DataFrame,
+# a writer takes (df, filename)
+BACKENDS = {
+    '.parquet': (_read_parquet, _write_parquet),
+    '.feather': (_read_feather, _write_feather)}
+
+
+# Add another columnar format
+def register_backend(extension, reader, writer):
+    BACKENDS[extension.lower()] = (reader, writer)
+
+
+# True if the file should be stored in a columnar format instead of CSV
+def is_columnar(filename):
+    return os.path.splitext(filename)[1].lower() in BACKENDS
+
+
+# Read only the requested columns, and optionally only one user's rows
+def read_columnar(filename, columns=None, user_id=None):
+    if not os.path.exists(filename):
+        return None
+    reader, _ = BACKENDS[os.path.splitext(filename)[1].lower()]
+    if columns is not None and user_id is not None and 'id' not in columns:
+        columns = ['id'] + list(columns)
+    return reader(filename, columns=columns, user_id=user_id)
+
+
+# Read a columnar file a chunk of rows at a time (Parquet streams row batches,
+# other formats are loaded once and sliced)
+def iter_columnar(filename, chunksize, columns=None):
+    if not os.path.exists(filename):
+        return
+    if os.path.splitext(filename)[1].lower() == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+        return
+    df = read_columnar(filename, columns)
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+# Write the whole table to a temporary file and swap it in
+def write_columnar(df, filename):
+    _, writer = BACKENDS[os.path.splitext(filename)[1].lower()]
+    extension = os.path.splitext(filename)[1]
+    temp_name = filename + '.tmp' + extension
+    # keep IC numbers as text so leading zeros survive
+    df = df.astype({'ic_number': str}) if 'ic_number' in df else df
+    writer(df, temp_name)
+    # the writers close the file themselves, so reopen it to get it on disk before the swap
+    with open(temp_name, 'r+b') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_name, filename)
+
+
+# One-shot migration: copy the existing CSV (latest version of every user) into a columnar file
+def migrate_csv(source='tax_records.csv', destination='tax_records.parquet'):
+    from functions2 import read_from_csv
+    df = read_from_csv(source)
+    if df is None:
+        return 0
+    write_columnar(df, destination)
+    return len(df)
+
+
+if __name__ == "__main__":
+    import sys
+    source = sys.argv[1] if len(sys.argv) > 1 else 'tax_records.csv'
+    destination = sys.argv[2] if len(sys.argv) > 2 else 'tax_records.parquet'
+    print(f"Migrated {migrate_csv(source, destination)} records from {source} to {destination}")
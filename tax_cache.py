@@ -0,0 +1,86 @@
+# tax_cache.py
+# Optional memoization for calculate_tax. Many payers end up with the same chargeable
+# income (same salary band, same default reliefs), so results are kept in a bounded
+# least-recently-used cache keyed on (year, chargeable income).
+# The cache empties itself when the tax rules change and is safe to share between threads.
+
+import threading
+from collections import OrderedDict
+
+import metrics
+import tax_rules
+from functions2 import calculate_tax
+from tax_rules import DEFAULT_YEAR, get_tax_rules
+
+
+class TaxCache:
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._results = OrderedDict()   # (year, chargeable income) -> tax payable
+        self._lock = threading.Lock()
+        self._rules_version = tax_rules.rules_version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Tax payable for an income and total relief, from the cache when possible
+    def calculate_tax(self, income, tax_relief, year=DEFAULT_YEAR):
+        rules = get_tax_rules(year)
+        chargeable_income = float(income - tax_relief)
+        # everything in the tax-free band has the same answer, so share one entry
+        if chargeable_income <= rules.tax_free:
+            chargeable_income = float(rules.tax_free)
+        key = (year, chargeable_income)
+
+        with self._lock:
+            if self._rules_version != tax_rules.rules_version:
+                self._results.clear()
+                self._rules_version = tax_rules.rules_version
+                self.invalidations += 1
+            tax_payable = self._results.get(key)
+            if tax_payable is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+                metrics.count('cache_hits_total', cache='tax')
+                return tax_payable
+            self.misses += 1
+            metrics.count('cache_misses_total', cache='tax')
+            version = self._rules_version
+
+        # calculate outside the lock so other threads aren't held up
+        tax_payable = calculate_tax(chargeable_income, 0, year)
+
+        with self._lock:
+            # don't store a result worked out from rules that have since been replaced
+            if version != tax_rules.rules_version:
+                return tax_payable
+            self._results[key] = tax_payable
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.evictions += 1
+        return tax_payable
+
+    # Empty the cache (the statistics are kept)
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    # Hit/miss/eviction counts and current size
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self._results),
+                    'maxsize': self.maxsize, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+# Shared cache for callers that just want memoized tax
+default_cache = TaxCache()
+
+
+# Drop-in replacement for functions2.calculate_tax that goes through default_cache
+def cached_calculate_tax(income, tax_relief, year=DEFAULT_YEAR):
+    return default_cache.calculate_tax(income, tax_relief, year)
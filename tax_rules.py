@@ -0,0 +1,118 @@
+# tax_rules.py
+# Tax brackets and relief limits for each assessment year.
+# The rules are read from tax_rules.json once, and the cumulative tax at the start of
+# every bracket is worked out up front so calculating tax is one lookup plus one multiply-add.
+
+import json
+import os
+import threading
+
+DEFAULT_YEAR = 2024
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tax_rules.json')
+
+# year -> TaxRules, filled from RULES_FILE on first use
+_rules = {}
+_loaded = False
+_lock = threading.Lock()
+
+# Goes up every time a year's rules are (re)registered, so caches of tax results can tell
+# when the brackets they were built from have changed
+rules_version = 0
+
+
+class TaxRules:
+
+    def __init__(self, year, brackets, reliefs, child_relief, max_children):
+        self.year = year
+        # brackets: list of (lower limit, rate), lowest first
+        self.brackets = [(lower, rate) for lower, rate in brackets]
+        # reliefs: list of (define name, max amount, name, description) like tax_relief() uses
+        self.reliefs = [tuple(relief) for relief in reliefs]
+        self.relief_limits = {define_name: max_amount for define_name, max_amount, _, _ in self.reliefs}
+        # the columns that make up total_relief, in the order every total is added up
+        # (so the same reliefs give the same total to the cent wherever it's worked out)
+        self.relief_columns = [define_name for define_name, _, _, _ in self.reliefs] + ['child_relief']
+        self.child_relief = child_relief
+        self.max_children = max_children
+
+        self.lowers = [float(lower) for lower, _ in self.brackets]
+        self.rates = [float(rate) for _, rate in self.brackets]
+        # Tax owed at the start of each bracket, added up bracket by bracket in the same
+        # order as the old if-chain so the floating point result is identical
+        self.base = [0.0]
+        for k in range(1, len(self.brackets)):
+            self.base.append(self.base[-1] + (self.lowers[k] - self.lowers[k - 1]) * self.rates[k - 1])
+        # Chargeable income up to here pays nothing (the end of a 0% first bracket)
+        self.tax_free = self.lowers[1] if self.rates[0] == 0 and len(self.lowers) > 1 else self.lowers[0]
+        self._arrays = None
+
+    # numpy copies of lowers / rates / base for calculate_tax_batch, made on first use
+    # so numpy isn't loaded just to look up one payer's tax
+    def _numpy_arrays(self):
+        if self._arrays is None:
+            import numpy as np
+            self._arrays = (np.array(self.lowers), np.array(self.rates), np.array(self.base))
+        return self._arrays
+
+    @property
+    def lowers_array(self):
+        return self._numpy_arrays()[0]
+
+    @property
+    def rates_array(self):
+        return self._numpy_arrays()[1]
+
+    @property
+    def base_array(self):
+        return self._numpy_arrays()[2]
+
+
+# Read every year in the rules file (only done once)
+def _load_rules_file():
+    global _loaded
+    with _lock:
+        if _loaded:
+            return
+        with open(RULES_FILE) as f:
+            data = json.load(f)
+        for year, rules in data.items():
+            year = int(year)
+            if year not in _rules:
+                _rules[year] = TaxRules(year, [(b['from'], b['rate']) for b in rules['brackets']],
+                                        rules['reliefs'], rules['child_relief'], rules['max_children'])
+        _loaded = True
+
+
+# Get the rules for an assessment year
+def get_tax_rules(year=DEFAULT_YEAR):
+    rules = _rules.get(year)
+    if rules is None:
+        _load_rules_file()
+        rules = _rules.get(year)
+        if rules is None:
+            raise ValueError(f"No tax rules for assessment year {year}")
+    return rules
+
+
+# Years that have rules
+def available_years():
+    _load_rules_file()
+    return sorted(_rules)
+
+
+# Add or replace the rules for a year (e.g. a new budget) without editing the rules file
+def register_tax_rules(year, brackets, reliefs, child_relief=8000, max_children=12):
+    global rules_version
+    _load_rules_file()
+    with _lock:
+        _rules[year] = TaxRules(year, brackets, reliefs, child_relief, max_children)
+        rules_version += 1
+    return _rules[year]
+
+
+# Check a single relief amount (or 'num_children') against the year's limits
+def validate_relief(define_name, amount, year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
+    if define_name == 'num_children':
+        return amount == int(amount) and 0 <= amount <= rules.max_children
+    return 0 <= amount <= rules.relief_limits[define_name]
@@ -0,0 +1,259 @@
+# tax_service.py
+# HTTP JSON front end for the tax calculator, so many clerks can use one process.
+# Built on asyncio streams; anything that touches the record files runs in a worker
+# thread so the event loop keeps serving other requests.
+# Usage: python tax_service.py --port 8080
+#
+# Endpoints (request and response bodies are JSON):
+#   POST /login          {"id", "password"}                    -> {"ok": true, "id", "token", "expires_in"}
+#   GET  /records/<id>   (token for <id>)                       -> the saved tax record
+#   POST /quote          {"income", reliefs..., "num_children", "year"?}
+#                                                               -> relief total, chargeable income, tax
+#   POST /file           {"id", "ic_number", "password", "income", reliefs..., "num_children",
+#                         "update"?, "year"?}                   -> the saved tax record
+#                        (an update needs a token for "id" instead of the password)
+# The token from /login is sent as "Authorization: Bearer <token>"; it only works for the user
+# who logged in and expires after credentials.SESSION_TTL seconds.
+
+import argparse
+import asyncio
+import json
+import math
+from http import HTTPStatus
+from urllib.parse import unquote
+
+from credentials import get_credential_store
+from functions2 import (RECORDS_FILE, authenticate_user, check_user_exists, get_user_record,
+                        register_password, save_to_csv, verify_user)
+from tax_cache import cached_calculate_tax
+from tax_rules import DEFAULT_YEAR, get_tax_rules, validate_relief
+
+MAX_BODY = 1024 * 1024
+
+
+# A request that can't be served; turned into a JSON error response
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# Check the income and relief fields of a request and work out the tax.
+# Returns the record fields (without id / IC / password).
+def _tax_from_body(body):
+    try:
+        year = int(body.get('year', DEFAULT_YEAR))
+        rules = get_tax_rules(year)
+    except ValueError as e:
+        raise RequestError(HTTPStatus.BAD_REQUEST, str(e))
+
+    try:
+        income = float(body['income'])
+    except (KeyError, TypeError, ValueError):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "income must be a valid number")
+    # float() takes "nan" / "inf" (and json.loads NaN / Infinity), which would poison the totals
+    if not math.isfinite(income):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "income must be a valid number")
+    if income < 0:
+        raise RequestError(HTTPStatus.BAD_REQUEST, "Income cannot be negative!")
+
+    reliefs = {}
+    for define_name, max_amount, name, _ in rules.reliefs:
+        try:
+            amount = float(body.get(define_name, 0))
+        except (TypeError, ValueError):
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"{name} must be a valid number")
+        if not math.isfinite(amount):
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"{name} must be a valid number")
+        if not validate_relief(define_name, amount, year):
+            raise RequestError(HTTPStatus.BAD_REQUEST, f"{name} must be between 0 and {max_amount}")
+        reliefs[define_name] = amount
+    try:
+        num_children = int(body.get('num_children', 0))
+    except (TypeError, ValueError, OverflowError):
+        raise RequestError(HTTPStatus.BAD_REQUEST, "num_children must be a whole number")
+    if not validate_relief('num_children', num_children, year):
+        raise RequestError(HTTPStatus.BAD_REQUEST, f"num_children must be between 0 and {rules.max_children}")
+
+    reliefs['child_relief'] = num_children * rules.child_relief
+    reliefs['num_children'] = num_children
+    # same order as tax_relief() adds them up
+    total_relief = sum(reliefs[column] for column in rules.relief_columns)
+    return dict(reliefs, income=income, total_relief=total_relief,
+                chargeable_income=max(0, income - total_relief),
+                tax_payable=cached_calculate_tax(income, total_relief, year))
+
+
+# Turn numpy values from a pandas record into plain JSON types (empty cells become null),
+# leaving out the password column that records saved before the credential store still have
+def _public_record(record):
+    values = {key: (value.item() if hasattr(value, 'item') else value)
+              for key, value in record.items() if key != 'password'}
+    return {key: (None if isinstance(value, float) and not math.isfinite(value) else value)
+            for key, value in values.items()}
+
+
+class TaxService:
+
+    def __init__(self, filename=RECORDS_FILE):
+        self.filename = filename
+
+    async def login(self, body):
+        user_id = str(body.get('id', '')).strip()
+        exists, saved_ic_number = await asyncio.to_thread(check_user_exists, user_id, self.filename)
+        if not exists:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"User ID '{user_id}' not found!")
+        # the password hash is slow on purpose, so check it off the event loop
+        if not await asyncio.to_thread(authenticate_user, user_id, saved_ic_number,
+                                       str(body.get('password', '')), self.filename):
+            raise RequestError(HTTPStatus.UNAUTHORIZED, "Invalid password!")
+        store = get_credential_store(self.filename)
+        return {'ok': True, 'id': user_id, 'token': store.start_session(user_id), 'expires_in': store.session_ttl}
+
+    # Make sure the request carries a current login token for this user
+    def _require_session(self, token, user_id):
+        if not get_credential_store(self.filename).check_session(token, user_id):
+            raise RequestError(HTTPStatus.UNAUTHORIZED, f"Log in as '{user_id}' first (POST /login)")
+
+    async def record(self, user_id, token=None):
+        self._require_session(token, user_id)
+        record = await asyncio.to_thread(get_user_record, user_id, self.filename)
+        if record is None:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"User ID '{user_id}' not found!")
+        return _public_record(record)
+
+    async def quote(self, body):
+        return _tax_from_body(body)
+
+    async def file(self, body, token=None):
+        user_id = str(body.get('id', '')).strip()
+        ic_number = str(body.get('ic_number', '')).strip()
+        password = str(body.get('password', '')).strip()
+        update = bool(body.get('update', False))
+        if not user_id:
+            raise RequestError(HTTPStatus.BAD_REQUEST, "User ID cannot be empty!")
+
+        exists, saved_ic_number = await asyncio.to_thread(check_user_exists, user_id, self.filename)
+        if exists and not update:
+            raise RequestError(HTTPStatus.CONFLICT, f"User ID '{user_id}' already exists! Please login instead.")
+        if update and not exists:
+            raise RequestError(HTTPStatus.NOT_FOUND, f"User ID '{user_id}' not found!")
+        if exists:
+            self._require_session(token, user_id)
+            ic_number = saved_ic_number
+        elif not verify_user(ic_number, password):
+            raise RequestError(HTTPStatus.UNAUTHORIZED, "Password does not match last 4 digits of IC!")
+
+        tax = _tax_from_body(body)
+        data = {'id': user_id, 'ic_number': ic_number, 'income': tax['income'],
+                'individual_relief': tax.get('individual_relief', 0), 'spouse_relief': tax.get('spouse_relief', 0),
+                'child_relief': tax['child_relief'], 'num_children': tax['num_children'],
+                'medical_relief': tax.get('medical_relief', 0), 'lifestyle_relief': tax.get('lifestyle_relief', 0),
+                'education_relief': tax.get('education_relief', 0), 'parental_relief': tax.get('parental_relief', 0),
+                'total_relief': tax['total_relief'], 'chargeable_income': tax['chargeable_income'],
+                'tax_payable': tax['tax_payable']}
+        if not await asyncio.to_thread(save_to_csv, dict(data), self.filename, update):
+            if not update and (await asyncio.to_thread(check_user_exists, user_id, self.filename))[0]:
+                # someone else registered this ID between our check and the save
+                raise RequestError(HTTPStatus.CONFLICT, f"User ID '{user_id}' already exists! Please login instead.")
+            raise RequestError(HTTPStatus.INTERNAL_SERVER_ERROR, "Error saving tax record!")
+        if not exists:
+            await asyncio.to_thread(register_password, user_id, password, self.filename)
+        return _public_record(data)
+
+    # Route one request to its handler (token: the bearer token from the Authorization header)
+    async def dispatch(self, method, path, body, token=None):
+        if method == 'POST' and path == '/login':
+            return await self.login(body)
+        if method == 'GET' and path.startswith('/records/'):
+            return await self.record(unquote(path[len('/records/'):]), token)
+        if method == 'POST' and path == '/quote':
+            return await self.quote(body)
+        if method == 'POST' and path == '/file':
+            return await self.file(body, token)
+        raise RequestError(HTTPStatus.NOT_FOUND, f"No endpoint {method} {path}")
+
+    # Serve requests on one connection until the client closes it (HTTP/1.1 keep-alive)
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {'error': "Bad request line"}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version.upper() == 'HTTP/1.1')
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > MAX_BODY:
+                        raise RequestError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large")
+                    raw = await reader.readexactly(length) if length else b''
+                    body = json.loads(raw) if raw else {}
+                    if not isinstance(body, dict):
+                        raise RequestError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object")
+                    scheme, _, token = headers.get('authorization', '').partition(' ')
+                    token = token.strip() if scheme.lower() == 'bearer' else None
+                    status, result = HTTPStatus.OK, await self.dispatch(method.upper(), target.split('?')[0], body, token)
+                except RequestError as e:
+                    status, result = e.status, {'error': e.message}
+                except json.JSONDecodeError:
+                    status, result = HTTPStatus.BAD_REQUEST, {'error': "Request body is not valid JSON"}
+                except Exception as e:
+                    status, result = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}
+                await self._respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, result, keep_alive):
+        try:
+            payload = json.dumps(result, allow_nan=False).encode('utf-8')
+        except ValueError:
+            # NaN / Infinity aren't JSON, so never send them
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            payload = json.dumps({'error': "Result is not a valid JSON number"}).encode('utf-8')
+        head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+
+# Start the service and run until interrupted
+async def serve(host='127.0.0.1', port=8080, filename=RECORDS_FILE):
+    service = TaxService(filename)
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f"Tax service listening on http://{host}:{port} (records: {filename})", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP JSON service for the tax calculator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--records', default=RECORDS_FILE, help="tax records file to use")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.records))
+    except KeyboardInterrupt:
+        pass
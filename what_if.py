@@ -0,0 +1,136 @@
+# what_if.py
+# "How much would I save if I claimed more relief?" for one payer, without going through
+# tax_relief() again for every idea. Candidate relief amounts are checked against the year's
+# caps and child limit and all of them are taxed in one calculate_tax_batch call, so thousands
+# of scenarios take a few milliseconds.
+# Usage:
+#   record = get_user_record('Ali_Ahmad')
+#   marginal_savings(record)                    # saving per extra ringgit of each relief
+#   what_if(record, [{'medical_relief': 8000}, {'lifestyle_relief': 2500, 'num_children': 2}])
+#   what_if(record, relief_grid(record))        # every combination up to the caps
+
+import itertools
+from bisect import bisect_left
+
+import numpy as np
+import pandas as pd
+
+from functions2 import calculate_tax_batch
+from tax_rules import DEFAULT_YEAR, get_tax_rules
+
+# Largest amount each relief can be for the year (child relief: per child x max children)
+def relief_caps(year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
+    caps = dict(rules.relief_limits)
+    caps['child_relief'] = rules.child_relief * rules.max_children
+    return caps
+
+
+# Tax for a payer under each candidate set of reliefs.
+# scenarios: a DataFrame (or list of dicts / dict of lists) with any of the relief columns and
+# num_children; a column (or a blank in one) keeps the payer's current value. Child relief always comes
+# from num_children. Amounts outside the caps or child limit raise ValueError.
+# Returns one row per scenario: the reliefs used, total_relief, chargeable_income, tax_payable
+# and saving (against the payer's tax with their current reliefs).
+def what_if(record, scenarios, year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
+    scenarios = scenarios if isinstance(scenarios, pd.DataFrame) else pd.DataFrame(scenarios)
+    if 'child_relief' in scenarios:
+        raise ValueError("Give num_children instead of child_relief")
+    n = len(scenarios)
+
+    columns = {}
+    for define_name, max_amount, name, _ in rules.reliefs:
+        if define_name in scenarios:
+            amount = scenarios[define_name].fillna(float(record.get(define_name, 0))).to_numpy(dtype=np.float64)
+        else:
+            amount = np.full(n, float(record.get(define_name, 0)))
+        bad = np.isnan(amount) | (amount < 0) | (amount > max_amount)
+        if bad.any():
+            raise ValueError(f"{name} must be between 0 and {max_amount} "
+                             f"(scenario {int(np.argmax(bad))} has {amount[bad][0]})")
+        columns[define_name] = amount
+
+    if 'num_children' in scenarios:
+        children = scenarios['num_children'].fillna(float(record.get('num_children', 0))).to_numpy(dtype=np.float64)
+    else:
+        children = np.full(n, float(record.get('num_children', 0)))
+    bad = np.isnan(children) | (children != np.round(children)) | (children < 0) | (children > rules.max_children)
+    if bad.any():
+        raise ValueError(f"Number of children must be a whole number between 0 and {rules.max_children} "
+                         f"(scenario {int(np.argmax(bad))} has {children[bad][0]})")
+    columns['num_children'] = children.astype(int)
+    columns['child_relief'] = children * rules.child_relief
+
+    # added up in the same order as tax_relief() (so totals match it to the cent)
+    total_relief = np.zeros(n)
+    for column in rules.relief_columns:
+        total_relief = total_relief + columns[column]
+    income = float(record['income'])
+    chargeable_income, tax_payable = calculate_tax_batch(np.full(n, income), total_relief, year)
+    _, (current_tax,) = calculate_tax_batch([income], [_current_total(record, rules)], year)
+
+    result = pd.DataFrame(columns, index=scenarios.index)
+    result['total_relief'] = total_relief
+    result['chargeable_income'] = chargeable_income
+    result['tax_payable'] = tax_payable
+    result['saving'] = np.round(current_tax - tax_payable, 2)
+    return result
+
+
+# The payer's total relief as tax_relief() would add it up
+def _current_total(record, rules):
+    amounts = {column: float(record.get(column, 0)) for column in rules.relief_columns}
+    amounts['child_relief'] = float(record.get('num_children', 0)) * rules.child_relief
+    return sum(amounts[column] for column in rules.relief_columns)
+
+
+# Tax rate on the last ringgit of chargeable income, i.e. what one more ringgit of relief saves
+def _marginal_rate(rules, chargeable_income):
+    if chargeable_income <= 0:
+        return 0.0
+    return rules.rates[max(0, bisect_left(rules.lowers, chargeable_income) - 1)]
+
+
+# For each relief: how much more could be claimed, what the next ringgit would save (the
+# payer's marginal rate, or 0 once the relief is at its cap), and what claiming all the way
+# to the cap would save in total and per ringgit.
+# Child relief is counted in whole children. The savings at the cap come from one what_if() pass.
+def marginal_savings(record, year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
+    caps = relief_caps(year)
+    children = int(record.get('num_children', 0))
+    # taken from the bracket rather than by taxing one more ringgit, which rounding to
+    # the cent would swamp
+    rate = _marginal_rate(rules, float(record['income']) - _current_total(record, rules))
+    rows, scenarios = [], []
+    for define_name, _, name, _ in rules.reliefs:
+        rows.append((define_name, name, float(record.get(define_name, 0)), caps[define_name]))
+        scenarios.append({define_name: caps[define_name]})
+    rows.append(('child_relief', 'Child Relief', float(children * rules.child_relief), caps['child_relief']))
+    scenarios.append({'num_children': rules.max_children})
+
+    savings = what_if(record, pd.DataFrame(scenarios), year)['saving'].to_numpy()
+    result = pd.DataFrame(rows, columns=['relief', 'name', 'current', 'cap'])
+    headroom = (result['cap'] - result['current']).to_numpy()
+    result['headroom'] = headroom
+    result['saving_per_ringgit'] = np.where(headroom > 0, rate, 0.0)
+    result['saving_at_cap'] = savings
+    result['saving_per_ringgit_to_cap'] = np.divide(savings, headroom, out=np.zeros(len(result)), where=headroom > 0)
+    return result.set_index('relief')
+
+
+# Every combination of the given reliefs from the payer's current amount up to the cap, in
+# `steps` even steps each (num_children goes up one child at a time). Feed it to what_if().
+def relief_grid(record, reliefs=('medical_relief', 'lifestyle_relief', 'parental_relief'), steps=10,
+                year=DEFAULT_YEAR):
+    rules = get_tax_rules(year)
+    axes = []
+    for define_name in reliefs:
+        if define_name == 'num_children':
+            axes.append(np.arange(int(record.get('num_children', 0)), rules.max_children + 1))
+        elif define_name in rules.relief_limits:
+            axes.append(np.linspace(float(record.get(define_name, 0)), rules.relief_limits[define_name], steps + 1).round(2))
+        else:
+            raise ValueError(f"Unknown relief '{define_name}'")
+    return pd.DataFrame(list(itertools.product(*axes)), columns=list(reliefs))